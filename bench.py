@@ -0,0 +1,278 @@
+"""Load test for Zia Edge: N simulated students hammering /ask and /ask/stream.
+
+Against a throwaway server running the deterministic stand-in model:
+
+    python bench.py --spawn --clients 50 --requests 4
+
+Against a running server (real model or not):
+
+    python bench.py --url http://192.168.1.5:8080 --clients 20 --endpoint stream
+
+Reports p50/p95/p99 latency, time-to-first-token, throughput and rejection rate.
+Only the standard library is used so it runs on any plain Linux box.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+QUESTIONS = [
+    "What is photosynthesis?",
+    "Explain Deluge scripting",
+    "Difference between HBase and Hive?",
+    "What is Zoho CRM?",
+    "How do plants make food?",
+    "Why is the sky blue?",
+    "What is a prime number?",
+    "Summarize the water cycle",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def post(url, payload, timeout):
+    body = json.dumps(payload).encode('utf-8')
+    req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    return urllib.request.urlopen(req, timeout=timeout)
+
+
+def ask_once(base_url, payload, timeout):
+    """One buffered /ask call; time-to-first-token equals total latency here.
+
+    ``tokens`` is the server's count of generated tokens (none for a cached
+    answer), the same unit stream_once counts in token events.
+    """
+    start = time.perf_counter()
+    with post(f"{base_url}/ask", payload, timeout) as resp:
+        data = json.loads(resp.read().decode('utf-8'))
+    latency = time.perf_counter() - start
+    if not data.get("success"):
+        return {"status": "error", "latency": latency, "error": data.get("error")}
+    return {"status": "ok", "latency": latency, "ttft": latency,
+            "tokens": data.get("tokens", 0), "cached": data.get("cached", False)}
+
+
+def stream_once(base_url, payload, timeout):
+    """One /ask/stream call, timing the first token event separately."""
+    start = time.perf_counter()
+    ttft = None
+    tokens = 0
+    event = None
+    result = {"status": "error", "error": "stream ended without a done event"}
+    with post(f"{base_url}/ask/stream", payload, timeout) as resp:
+        if 'text/event-stream' not in resp.headers.get('Content-Type', ''):
+            data = json.loads(resp.read().decode('utf-8'))
+            return {"status": "error", "latency": time.perf_counter() - start, "error": data.get("error")}
+        for raw in resp:
+            line = raw.decode('utf-8').rstrip('\n')
+            if line.startswith('event: '):
+                event = line[7:]
+            elif line.startswith('data: '):
+                if event == 'token':
+                    tokens += 1
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                elif event == 'done':
+                    data = json.loads(line[6:])
+                    result = {"status": "ok", "cached": data.get("cached", False)}
+                    if result["cached"]:
+                        # A cached answer arrives as one event and generated nothing
+                        tokens = 0
+                    break
+                elif event == 'error':
+                    result = {"status": "error", "error": json.loads(line[6:]).get("error")}
+                    break
+    latency = time.perf_counter() - start
+    result.update(latency=latency, ttft=ttft if ttft is not None else latency, tokens=tokens)
+    return result
+
+
+def run_client(client_id, args, results, lock):
+    """One simulated student sending ``args.requests`` questions back to back."""
+    for n in range(args.requests):
+        if args.distinct_questions:
+            question = QUESTIONS[(client_id + n) % min(args.distinct_questions, len(QUESTIONS))]
+        else:
+            question = f"{QUESTIONS[(client_id + n) % len(QUESTIONS)]} (client {client_id}, #{n})"
+        payload = {"message": question, "fresh": not args.distinct_questions}
+        if args.endpoint == "both":
+            endpoint = "stream" if (client_id + n) % 2 else "ask"
+        else:
+            endpoint = args.endpoint
+
+        start = time.perf_counter()
+        try:
+            call = stream_once if endpoint == "stream" else ask_once
+            result = call(args.url, payload, args.timeout)
+        except urllib.error.HTTPError as e:
+            status = "rejected" if e.code in (429, 503) else "error"
+            result = {"status": status, "latency": time.perf_counter() - start, "error": f"HTTP {e.code}"}
+        except Exception as e:
+            result = {"status": "error", "latency": time.perf_counter() - start, "error": str(e)}
+        result["endpoint"] = endpoint
+        with lock:
+            results.append(result)
+        if args.think_time:
+            time.sleep(args.think_time)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(args):
+    """Start zoho.py in a subprocess, by default on the fake backend."""
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "SERVER_PORT": str(port),
+        "MODEL_BACKEND": args.backend,
+        "MODEL_INSTANCES": str(args.instances),
+        "FAKE_TOKEN_DELAY": str(args.token_delay),
+        "FAKE_PROMPT_EVAL_DELAY": str(args.prompt_eval_delay),
+        "FAKE_ANSWER_TOKENS": str(args.answer_tokens),
+        # Every simulated client shares 127.0.0.1, so per-client rate limits would throttle the whole run
+        "RATE_LIMIT_REQUESTS_PER_MINUTE": "0",
+        "RATE_LIMIT_TOKENS_PER_MINUTE": "0",
+    })
+    for item in args.server_env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    here = os.path.dirname(os.path.abspath(__file__))
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    proc = subprocess.Popen([sys.executable, os.path.join(here, 'zoho.py')], cwd=here, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def wait_for_server(base_url, proc, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode}")
+        try:
+            # 503 until the model pool is loaded and warmed
+            with urllib.request.urlopen(f"{base_url}/health/ready", timeout=2):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.25)
+    raise RuntimeError(f"server at {base_url} did not become ready within {timeout}s")
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r["status"] == "ok"]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok]
+    tokens = sum(r.get("tokens", 0) for r in ok)
+    total = len(results)
+    return {
+        "requests": total,
+        "ok": len(ok),
+        "rejected": sum(1 for r in results if r["status"] == "rejected"),
+        "errors": sum(1 for r in results if r["status"] == "error"),
+        "rejection_rate": round(sum(1 for r in results if r["status"] == "rejected") / total, 4) if total else 0.0,
+        "cached": sum(1 for r in ok if r.get("cached")),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        "throughput_tokens_per_s": round(tokens / elapsed, 2) if elapsed else 0.0,
+        "latency_s": {f"p{p}": round(percentile(latencies, p), 3) for p in (50, 95, 99)},
+        "ttft_s": {f"p{p}": round(percentile(ttfts, p), 3) for p in (50, 95, 99)},
+    }
+
+
+def print_report(summary, by_endpoint):
+    print(f"\n📊 {summary['requests']} requests in {summary['elapsed_s']}s")
+    print(f"   ok {summary['ok']} • rejected {summary['rejected']} ({summary['rejection_rate']:.1%}) • errors {summary['errors']} • cached {summary['cached']}")
+    print(f"   throughput {summary['throughput_rps']} req/s • {summary['throughput_tokens_per_s']} tokens/s")
+    print(f"   {'':10} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for label, key in (("latency", "latency_s"), ("ttft", "ttft_s")):
+        row = summary[key]
+        print(f"   {label:10} {row['p50']:>7.3f}s {row['p95']:>7.3f}s {row['p99']:>7.3f}s")
+    for endpoint, part in by_endpoint.items():
+        print(f"   [{endpoint}] ok {part['ok']} • latency p95 {part['latency_s']['p95']:.3f}s • ttft p95 {part['ttft_s']['p95']:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Zia Edge load test")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', default="http://127.0.0.1:8080", help="server to test (default %(default)s)")
+    target.add_argument('--spawn', action='store_true', help="start a private zoho.py for the run")
+    parser.add_argument('--clients', type=int, default=10, help="concurrent simulated clients")
+    parser.add_argument('--requests', type=int, default=3, help="questions per client")
+    parser.add_argument('--endpoint', choices=("ask", "stream", "both"), default="both")
+    parser.add_argument('--distinct-questions', type=int, default=0,
+                        help="reuse this many fixed questions (exercises caching/coalescing); 0 makes every question unique")
+    parser.add_argument('--think-time', type=float, default=0.0, help="pause between a client's questions (s)")
+    parser.add_argument('--timeout', type=float, default=600.0, help="per-request timeout (s)")
+    parser.add_argument('--json', metavar='FILE', help="also write the summary as JSON")
+    parser.add_argument('--ready-timeout', type=float,
+                        help="how long to wait for /health/ready (s); default 60 for a spawned fake server, else 900 for a real model to load")
+    spawn = parser.add_argument_group("spawned server")
+    spawn.add_argument('--backend', choices=("fake", "gpt4all"), default="fake")
+    spawn.add_argument('--instances', default="1", help="MODEL_INSTANCES for the server")
+    spawn.add_argument('--token-delay', type=float, default=0.05, help="fake model seconds per generated token")
+    spawn.add_argument('--prompt-eval-delay', type=float, default=0.002, help="fake model seconds per prompt token")
+    spawn.add_argument('--answer-tokens', type=int, default=64, help="fake model answer length")
+    spawn.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE',
+                       help="extra environment for the spawned server (repeatable)")
+    spawn.add_argument('--server-log', metavar='FILE', help="keep the spawned server's output")
+    args = parser.parse_args()
+
+    proc = None
+    if args.spawn:
+        proc, args.url = spawn_server(args)
+    args.url = args.url.rstrip('/')
+
+    try:
+        print(f"⏳ Waiting for {args.url} ...")
+        ready_timeout = args.ready_timeout
+        if ready_timeout is None:
+            # --backend only describes a spawned server; one reached with --url may be loading a real model
+            ready_timeout = 60 if args.spawn and args.backend == "fake" else 900
+        wait_for_server(args.url, proc, ready_timeout)
+        print(f"🚀 {args.clients} clients x {args.requests} requests → {args.endpoint}")
+
+        results = []
+        lock = threading.Lock()
+        threads = [threading.Thread(target=run_client, args=(i, args, results, lock)) for i in range(args.clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=10)
+
+    summary = summarize(results, elapsed)
+    by_endpoint = {
+        endpoint: summarize([r for r in results if r["endpoint"] == endpoint], elapsed)
+        for endpoint in sorted({r["endpoint"] for r in results})
+    }
+    print_report(summary, by_endpoint)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"summary": summary, "by_endpoint": by_endpoint, "args": vars(args)}, f, indent=2)
+    return 0 if summary["errors"] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
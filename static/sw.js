@@ -0,0 +1,63 @@
+// Zia Edge service worker: keeps the app shell on the device so repeat visits
+// render instantly even before the hotspot answers. API calls are never cached.
+const CACHE = 'zia-edge-shell-v2';
+const SHELL = [
+    '/zia-chat',
+    '/',
+    '/manifest.json',
+    '/static/vendor/fontawesome-6.4.0/css/fontawesome.min.css',
+    '/static/vendor/fontawesome-6.4.0/css/solid.min.css',
+    '/static/vendor/fontawesome-6.4.0/webfonts/fa-solid-900.woff2',
+    '/static/vendor/inter-4.001/css/inter.css',
+    '/static/vendor/inter-4.001/webfonts/Inter-Regular.woff2',
+    '/static/vendor/inter-4.001/webfonts/Inter-SemiBold.woff2',
+    '/static/vendor/inter-4.001/webfonts/Inter-Bold.woff2',
+    '/static/icons/icon-192.png',
+    '/static/icons/icon-512.png',
+];
+const NEVER_CACHE = ['/ask', '/health', '/metrics', '/sw.js'];
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(CACHE).then(cache => cache.addAll(SHELL)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(key => key !== CACHE).map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== self.location.origin) return;
+    if (NEVER_CACHE.some(prefix => url.pathname.startsWith(prefix))) return;
+
+    if (url.pathname.startsWith('/static/vendor/')) {
+        // Versioned by path and served immutable: cache first, network only on a miss
+        event.respondWith(caches.match(request).then(hit => hit || fetchAndStore(request)));
+        return;
+    }
+
+    // Pages and everything else: answer from cache at once, refresh it in the background
+    event.respondWith(caches.match(request, {ignoreSearch: true}).then(hit => {
+        const refresh = fetchAndStore(request).catch(() => hit);
+        if (hit) {
+            event.waitUntil(refresh);
+            return hit;
+        }
+        return refresh;
+    }));
+});
+
+function fetchAndStore(request) {
+    return fetch(request).then(response => {
+        if (response.ok) {
+            const copy = response.clone();
+            caches.open(CACHE).then(cache => cache.put(request, copy));
+        }
+        return response;
+    });
+}
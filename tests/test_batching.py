@@ -0,0 +1,150 @@
+"""Scheduler tests for continuous batching, run against the fake backend's multi-sequence decoding.
+
+    pytest tests/
+
+Importing zoho starts its model loader, so the fake backend is forced with a
+single in-process instance that loads instantly.
+"""
+
+import contextlib
+import os
+import sys
+import threading
+import unittest
+
+os.environ["MODEL_BACKEND"] = "fake"
+os.environ["MODEL_INSTANCES"] = "1"
+os.environ["WORKER_PROCESSES"] = "0"
+os.environ.setdefault("FAKE_TOKEN_DELAY", "0.001")
+os.environ.setdefault("FAKE_PROMPT_EVAL_DELAY", "0")
+os.environ.setdefault("FAKE_LOAD_SECONDS", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import zoho
+
+
+class RecordingModel(zoho.FakeLLModel):
+    """Fake model that remembers which sequences each batched step decoded."""
+
+    def __init__(self, fail=False, fail_prompt=None, fail_remove=False):
+        super().__init__()
+        self.batches = []
+        self.fail = fail
+        self.fail_prompt = fail_prompt
+        self.fail_remove = fail_remove
+
+    def add_sequence(self, seq_id, prompt, **sampling):
+        if prompt == self.fail_prompt:
+            raise RuntimeError("prompt rejected")
+        super().add_sequence(seq_id, prompt, **sampling)
+
+    def remove_sequence(self, seq_id):
+        super().remove_sequence(seq_id)
+        if self.fail_remove:
+            raise RuntimeError("remove failed")
+
+    def decode_batch(self, seq_ids):
+        if self.fail:
+            raise RuntimeError("decode failed")
+        self.batches.append(list(seq_ids))
+        return super().decode_batch(seq_ids)
+
+
+def plain_answer(prompt, max_tokens):
+    return list(zoho.FakeLLModel().prompt_model_streaming(prompt, zoho.RAW_PROMPT_TEMPLATE, n_predict=max_tokens))
+
+
+def run_together(decoder, requests, hold=False):
+    """Start every (prompt, max_tokens, callback) at once and collect each one's tokens (or error).
+
+    With ``hold`` the decoder is kept busy until every request has queued, so
+    they all join in the same step.
+    """
+    results = [None] * len(requests)
+
+    def follow(i, tokens):
+        try:
+            results[i] = list(tokens)
+        except Exception as e:
+            results[i] = e
+
+    # generate() queues the request straight away; the decoder's lock is reentrant
+    with decoder._cond if hold else contextlib.nullcontext():
+        streams = [decoder.generate(prompt, callback or zoho.keep_generating, max_tokens)
+                   for prompt, max_tokens, callback in requests]
+    threads = [threading.Thread(target=follow, args=(i, tokens), daemon=True) for i, tokens in enumerate(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive(), "a caller is still waiting on the decoder"
+    return results
+
+
+class BatchDecoderTest(unittest.TestCase):
+
+    def test_sequences_decode_together_with_plain_answers(self):
+        model = RecordingModel()
+        decoder = zoho.BatchDecoder(model, max_sequences=4)
+        prompts = [f"question {i}" for i in range(4)]
+        results = run_together(decoder, [(prompt, 20, None) for prompt in prompts])
+        for prompt, tokens in zip(prompts, results):
+            self.assertEqual(tokens, plain_answer(prompt, 20))
+        # Far fewer steps than decoding the four answers one after another
+        self.assertLess(decoder.steps, 2 * 20)
+        self.assertGreater(max(len(batch) for batch in model.batches), 1)
+
+    def test_new_sequences_join_as_others_finish(self):
+        model = RecordingModel()
+        decoder = zoho.BatchDecoder(model, max_sequences=2)
+        results = run_together(decoder, [("short one", 3, None), ("long one", 12, None), ("another short", 3, None)])
+        self.assertEqual([len(tokens) for tokens in results], [3, 12, 3])
+        self.assertLessEqual(max(len(batch) for batch in model.batches), 2)
+        # The third question starts while the long one is still running
+        self.assertLess(decoder.steps, 12 + 3)
+        self.assertEqual(model.sequences, {})
+        self.assertEqual(decoder.active, 0)
+
+    def test_callback_stops_only_its_own_sequence(self):
+        decoder = zoho.BatchDecoder(RecordingModel(), max_sequences=2)
+        stop_after_two = lambda token_id, response: token_id < 2
+        stopped, full = run_together(decoder, [("stop early", 10, stop_after_two), ("keep going", 10, None)])
+        self.assertEqual(len(stopped), 2)
+        self.assertEqual(full, plain_answer("keep going", 10))
+
+    def test_sampling_settings_reach_the_backend(self):
+        model = RecordingModel()
+        seen = []
+        add_sequence = model.add_sequence
+        model.add_sequence = lambda seq_id, prompt, **sampling: (seen.append(sampling), add_sequence(seq_id, prompt, **sampling))
+        decoder = zoho.BatchDecoder(model, max_sequences=1)
+        config = dict(zoho.GENERATION_CONFIG, max_tokens=5)
+        list(decoder.generate("sampled", zoho.keep_generating, **config))
+        self.assertEqual(seen, [{key: value for key, value in config.items() if key != "max_tokens"}])
+
+    def test_failed_join_fails_only_that_caller(self):
+        model = RecordingModel(fail_prompt="doomed")
+        decoder = zoho.BatchDecoder(model, max_sequences=2)
+        doomed, fine = run_together(decoder, [("doomed", 5, None), ("fine", 5, None)], hold=True)
+        self.assertIsInstance(doomed, RuntimeError)
+        self.assertEqual(fine, plain_answer("fine", 5))
+        self.assertEqual(decoder.active, 0)
+
+    def test_errors_ending_a_sequence_keep_the_decoder_running(self):
+        decoder = zoho.BatchDecoder(RecordingModel(fail_remove=True), max_sequences=2)
+        def explode(token_id, response):
+            raise ValueError("callback failed")
+        exploded, first = run_together(decoder, [("explode", 5, explode), ("first", 5, None)])
+        self.assertIsInstance(exploded, ValueError)
+        self.assertEqual(first, plain_answer("first", 5))
+        # Still serving after both failures
+        self.assertEqual(run_together(decoder, [("later", 3, None)]), [plain_answer("later", 3)])
+
+    def test_backend_errors_reach_the_caller(self):
+        decoder = zoho.BatchDecoder(RecordingModel(fail=True), max_sequences=2)
+        with self.assertRaises(RuntimeError):
+            list(decoder.generate("doomed", zoho.keep_generating, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
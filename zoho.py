@@ -1,22 +1,84 @@
 
-from flask import Flask, request, jsonify, send_from_directory
-from gpt4all import GPT4All
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
+try:
+    from gpt4all import GPT4All
+except ImportError:  # MODEL_BACKEND=fake runs without it
+    GPT4All = None
 from flask_cors import CORS
+import argparse
+import asyncio
 import datetime
 import qrcode
 import io
 import base64
+import gzip
+import hashlib
+import hmac
+import ipaddress
+import json
+import math
+import mmap
 import os
+import platform
+import re
+import zlib
 import time
 import socket
-from threading import Lock
+import subprocess
+import sys
+from threading import Lock, Event, Condition, Thread, active_count
+
+try:
+    import numpy as np
+except ImportError:  # Semantic cache is optional
+    np = None
+
+try:
+    import brotli
+except ImportError:  # Pages are still served gzip-compressed
+    brotli = None
+
+try:
+    from flask_socketio import SocketIO
+except ImportError:  # Chat stays on HTTP streaming
+    SocketIO = None
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue, Empty
+
+# Set when this process was started as an inference worker (WORKER_PROCESSES=1). Its stdout
+# then carries the worker protocol, so everything else printed goes to stderr instead.
+WORKER_INDEX = int(os.environ["ZIA_WORKER_INDEX"]) if "ZIA_WORKER_INDEX" in os.environ else None
+if WORKER_INDEX is not None:
+    WORKER_PIPE = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+# `python zoho.py --batch FILE` writes NDJSON results to stdout (unless --output is given), so
+# from the start, banners included, every log line goes to stderr and only results reach stdout
+BATCH_RESULTS = None
+if WORKER_INDEX is None and __name__ == '__main__' and any(arg == '--batch' or arg.startswith('--batch=') for arg in sys.argv[1:]):
+    BATCH_RESULTS = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
 
 app = Flask(__name__, static_folder='static')
 CORS(app)
 
-print("🚀 Starting Zia Edge Enterprise Server...")
-print("🔒 Privacy Mode: OFFLINE AI • ENTERPRISE GRADE")
-print("💼 Zoho UI : ACTIVATED")
+# "flask" runs the threaded development server; "asgi" serves through uvicorn, where a
+# request waiting for the model is a coroutine instead of a blocked thread (needs fastapi and uvicorn)
+SERVER_MODE = os.environ.get("SERVER_MODE", "flask")
+# Threads the ASGI server lends to blocking work in front of the queue (cache embeddings)
+ASGI_EXECUTOR_THREADS = int(os.environ.get("ASGI_EXECUTOR_THREADS", 8))
+
+# Persistent WebSocket chat channel; without it the page falls back to /ask/stream.
+# Flask-SocketIO needs the Flask server, so the ASGI mode always streams over HTTP.
+WEBSOCKET_CHAT = SocketIO is not None and SERVER_MODE != "asgi" and os.environ.get("WEBSOCKET_CHAT", "1") == "1"
+socketio = SocketIO(app, async_mode='threading', cors_allowed_origins='*') if WEBSOCKET_CHAT else None
+
+if WORKER_INDEX is None:
+    print("🚀 Starting Zia Edge Enterprise Server...")
+    print("🔒 Privacy Mode: OFFLINE AI • ENTERPRISE GRADE")
+    print("💼 Zoho UI : ACTIVATED")
 
 # Get IP automatically like server.py
 def get_ip():
@@ -30,12 +92,22 @@ def get_ip():
         return "10.175.212.187"  # Fallback to your IP
 
 SERVER_IP = get_ip()
-SERVER_PORT = 8080
+SERVER_PORT = int(os.environ.get("SERVER_PORT", 8080))
 SERVER_URL = f"http://{SERVER_IP}:{SERVER_PORT}"
-print(f"📍 Server IP: {SERVER_IP}:{SERVER_PORT}")
+if WORKER_INDEX is None:
+    print(f"📍 Server IP: {SERVER_IP}:{SERVER_PORT}")
 
 # Generation/runtime tuning
-CPU_THREADS = max(1, (os.cpu_count() or 2) - 1)
+MODEL_NAME = "orca-2-7b.Q4_0.gguf"
+# "gpt4all" for the real model, "fake" for the deterministic stand-in used by bench.py
+MODEL_BACKEND = os.environ.get("MODEL_BACKEND", "gpt4all").lower()
+MODEL_RAM_GB = 4.5
+# What each extra instance adds (KV cache and scratch buffers): llama.cpp memory-maps the
+# weights read-only, so every instance and worker process shares one copy in the page cache
+INSTANCE_RAM_GB = 0.75
+# Read the weights file into the page cache in the background before the first instance loads
+MODEL_PREFETCH = os.environ.get("MODEL_PREFETCH", "1") == "1"
+CPU_THREADS = int(os.environ.get("MODEL_THREADS", 0)) or max(1, (os.cpu_count() or 2) - 1)
 GENERATION_TIMEOUT_SECONDS = int(os.environ.get("GENERATION_TIMEOUT_SECONDS", 500))
 MAX_RESPONSE_CHARS = int(os.environ.get("MAX_RESPONSE_CHARS", 4096))
 GENERATION_CONFIG = {
@@ -47,82 +119,2573 @@ GENERATION_CONFIG = {
     "repeat_last_n": 64,
     "n_batch": int(os.environ.get("MODEL_N_BATCH", 24))
 }
-model_lock = Lock()
 
-# Simple model loading exactly like server.py
-try:
-    model = GPT4All("orca-2-7b.Q4_0.gguf", n_threads=CPU_THREADS)
-    print("✅ Orca 2 7B Model Loaded Successfully!")
-    print(f"🧵 Using {CPU_THREADS} CPU threads for inference")
-    model_loaded = True
-except Exception as e:
-    print(f"❌ Model loading error: {e}")
-    print("📋 Please ensure 'orca-2-7b.Q4_0.gguf' is in your models folder")
-    model = None
-    model_loaded = False
+# Fixed preamble evaluated once per instance at startup and restored for every request
+SYSTEM_PROMPT = os.environ.get("SYSTEM_PROMPT", "").replace("\\n", "\n")
+
+# Prometheus-style metrics
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKEN_RATE_BUCKETS = (1, 2, 4, 6, 8, 10, 15, 20, 30, 50, 100)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {} if labelnames else {(): 0}
+        self._lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus exposition layout."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labelnames = labelnames
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key + (("le", bound),), bucket_count))
+                samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+                samples.append((f"{self.name}_sum", key, round(total, 6)))
+                samples.append((f"{self.name}_count", key, count))
+        return samples
+
+
+class Gauge:
+    """Value read from live server state at scrape time.
+
+    ``read`` returns a number, or a dict mapping label tuples to numbers.
+    """
+
+    def __init__(self, name, documentation, read, kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        self.kind = kind
+
+    def samples(self):
+        value = self.read()
+        if isinstance(value, dict):
+            return [(self.name, key, v) for key, v in value.items()]
+        return [(self.name, (), value)]
+
+
+METRICS = []
+
+
+def register(metric):
+    METRICS.append(metric)
+    return metric
+
+
+def render_metrics():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+QUEUE_WAIT_SECONDS = register(Histogram("zia_queue_wait_seconds", "Time a generation waited for a model instance.",
+                                         labelnames=("priority",)))
+TIME_TO_FIRST_TOKEN_SECONDS = register(Histogram("zia_time_to_first_token_seconds", "Queue wait plus prompt evaluation until the first token."))
+GENERATION_SECONDS = register(Histogram("zia_generation_seconds", "Wall time spent generating an answer."))
+TOKENS_PER_SECOND = register(Histogram("zia_tokens_per_second", "Decode speed of each generation.", TOKEN_RATE_BUCKETS))
+GENERATION_TIMEOUTS = register(Counter("zia_generation_timeouts_total", "Generations cut off by GENERATION_TIMEOUT_SECONDS."))
+LENGTH_TRUNCATIONS = register(Counter("zia_length_truncations_total", "Generations cut off by MAX_RESPONSE_CHARS."))
+ERRORS = register(Counter("zia_errors_total", "Requests that failed with an error.", ("endpoint",)))
+REJECTIONS = register(Counter("zia_rejections_total", "Requests turned away before generation.", ("reason",)))
+CANCELLATIONS = register(Counter("zia_cancellations_total", "Generations abandoned by every request following them.", ("reason",)))
+RATE_LIMITED = register(Counter("zia_rate_limited_total", "Requests refused by the per-client rate limit.", ("limit",)))
+RATE_LIMIT_TOKENS = register(Counter("zia_rate_limit_tokens_total", "Generated tokens charged to rate-limited clients."))
+WORKER_RESTARTS = register(Counter("zia_worker_restarts_total", "Inference worker processes restarted.", ("reason",)))
+
+# Admission control in front of the model
+MAX_QUEUE_DEPTH = int(os.environ.get("MAX_QUEUE_DEPTH", 32))
+QUEUE_WAIT_TIMEOUT_SECONDS = int(os.environ.get("QUEUE_WAIT_TIMEOUT_SECONDS", 120))
+# Hard per-request deadline covering queue wait and generation (0 disables);
+# clients can ask for a shorter one with the X-Request-Deadline header (seconds)
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", 180))
+DEADLINE_HEADER = "X-Request-Deadline"
+# How often waiting code checks for cancellation, deadlines and hung-up clients
+CANCEL_POLL_SECONDS = 0.25
+
+# Priority classes, highest first. A request is classed by its token (X-Zia-Token
+# header or a bearer token) or else by the network it comes from; everyone else
+# is a student. PRIORITY_TOKENS="teacher:s3cret,admin:t0ken",
+# PRIORITY_NETWORKS="teacher:192.168.1.0/28,admin:127.0.0.1/32"
+PRIORITY_CLASSES = ("admin", "teacher", "student")
+DEFAULT_PRIORITY = "student"
+BATCH_PRIORITY = "batch"
+PRIORITY_HEADER = "X-Zia-Token"
+
+
+def parse_priority_setting(setting, convert=str):
+    """Parse "class:value,..." into [(class, value)], skipping malformed entries."""
+    entries = []
+    for item in filter(None, (part.strip() for part in setting.split(','))):
+        priority, _, value = item.partition(':')
+        try:
+            if priority.strip() not in PRIORITY_CLASSES or not value.strip():
+                raise ValueError("expected class:value with a known class")
+            entries.append((priority.strip(), convert(value.strip())))
+        except ValueError as e:
+            print(f"⚠️ Ignoring priority entry {item!r}: {e}")
+    return entries
+
+
+PRIORITY_TOKENS = parse_priority_setting(os.environ.get("PRIORITY_TOKENS", ""))
+PRIORITY_NETWORKS = parse_priority_setting(os.environ.get("PRIORITY_NETWORKS", ""),
+                                           lambda value: ipaddress.ip_network(value, strict=False))
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue cannot admit another request."""
+
+    def __init__(self, retry_after):
+        super().__init__("Server is busy, too many questions are waiting. Please try again shortly.")
+        self.retry_after = retry_after
+
+
+class QueueTicket:
+    """A request's place in the inference queue."""
+
+    def __init__(self):
+        self.granted = Event()
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.instance = None
+        self.affinity = None
+        self.background = False
+        self.client = None
+        self.priority = DEFAULT_PRIORITY
+        self.on_grant = None
+
+    @property
+    def wait_time(self):
+        return (self.started_at or time.time()) - self.enqueued_at
+
+
+# Service time assumed for Retry-After hints until the first generation has finished
+RETRY_SERVICE_GUESS_SECONDS = 10
+
+
+class InferenceQueue:
+    """Bounded queue handing idle model instances to tickets by priority class, clients taking turns.
+
+    Background (batch) tickets only get an instance when no interactive one is waiting.
+    """
+
+    def __init__(self, max_depth):
+        self.max_depth = max_depth
+        self.slots = 0
+        self._lock = Lock()
+        # priority class -> client -> that client's waiting tickets; dict order is the turn order
+        self._lanes = {priority: OrderedDict() for priority in PRIORITY_CLASSES}
+        self._depth = 0
+        self._background = deque()
+        self._idle = []
+        self._active = 0
+        # Unknown until a generation has finished
+        self._avg_service_time = None
+        self._avg_wait = dict.fromkeys(PRIORITY_CLASSES + (BATCH_PRIORITY,), 0.0)
+
+    def add_instance(self, instance, slots=1):
+        """Register a loaded model instance; a batching instance answers ``slots`` tickets at once."""
+        with self._lock:
+            self.slots += slots
+            self._idle.extend([instance] * slots)
+            self._grant_next()
+
+    def submit(self, affinity=None, background=False, client=None, priority=DEFAULT_PRIORITY, on_grant=None):
+        """Join the queue, raising QueueFullError instead of waiting when it is full.
+
+        ``affinity`` names a session whose retained context should be preferred
+        when picking an idle instance. Background tickets are not counted
+        against max_depth; batch jobs bound how many they submit at once.
+        Only the lowest class is turned away by a full queue, so students
+        filling it never lock a teacher out. ``on_grant(ticket)`` is called,
+        under the queue lock, the moment the ticket gets its instance.
+        """
+        ticket = QueueTicket()
+        ticket.affinity = affinity
+        ticket.background = background
+        ticket.client = client
+        ticket.priority = BATCH_PRIORITY if background else priority
+        ticket.on_grant = on_grant
+        with self._lock:
+            if self._idle and not self._depth and not self._background:
+                self._grant(ticket)
+            elif background:
+                self._background.append(ticket)
+            elif self._depth >= self.max_depth and priority == PRIORITY_CLASSES[-1]:
+                raise QueueFullError(self._estimate_wait(self._depth))
+            else:
+                self._enqueue(ticket)
+        return ticket
+
+    def cancel(self, ticket):
+        """Withdraw a waiting ticket. Returns False if it was already granted a slot."""
+        with self._lock:
+            if ticket.granted.is_set():
+                return False
+            if ticket in self._background:
+                self._background.remove(ticket)
+            else:
+                self._dequeue(ticket)
+            return True
+
+    def promote(self, ticket, priority=DEFAULT_PRIORITY, client=None):
+        """Move a waiting ticket up to ``priority`` on behalf of ``client`` if that is a better place.
+
+        Lifts a background ticket into the interactive lanes, or an
+        interactive one into a higher class when a more important request
+        joins the same generation.
+        """
+        with self._lock:
+            if ticket.granted.is_set():
+                return
+            if ticket in self._background:
+                self._background.remove(ticket)
+                ticket.background = False
+            elif PRIORITY_CLASSES.index(priority) < PRIORITY_CLASSES.index(ticket.priority):
+                self._dequeue(ticket)
+            else:
+                return
+            ticket.priority = priority
+            ticket.client = client
+            self._enqueue(ticket)
+
+    def release(self, ticket):
+        """Free the ticket's slot and hand it to the next waiter."""
+        with self._lock:
+            service_time = time.time() - (ticket.started_at or time.time())
+            if self._avg_service_time is None:
+                self._avg_service_time = service_time
+            else:
+                self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * service_time
+            self._active -= 1
+            self._idle.append(ticket.instance)
+            self._grant_next()
+
+    def position(self, ticket):
+        """1-based place in the order tickets will be granted, or 0 once the ticket is running."""
+        with self._lock:
+            if ticket.granted.is_set():
+                return 0
+            if ticket in self._background:
+                return self._depth + self._background.index(ticket) + 1
+            ahead = 0
+            for priority in PRIORITY_CLASSES:
+                lane = self._lanes[priority]
+                if priority != ticket.priority:
+                    ahead += sum(len(line) for line in lane.values())
+                    continue
+                line = lane.get(ticket.client)
+                if not line or ticket not in line:
+                    return 0
+                rounds = line.index(ticket)
+                turn = list(lane).index(ticket.client)
+                # Every other client gets a go per round, plus one more if its turn comes before ours
+                for i, other in enumerate(lane.values()):
+                    if other is not line:
+                        ahead += min(len(other), rounds + (1 if i < turn else 0))
+                return ahead + rounds + 1
+            return 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "waiting": self._depth,
+                "background": len(self._background),
+                "active": self._active,
+                "slots": self.slots,
+                "max_depth": self.max_depth,
+                "avg_service_time": round(self._avg_service_time, 2) if self._avg_service_time is not None else None,
+                "waiting_by_class": {priority: sum(len(line) for line in lane.values()) for priority, lane in self._lanes.items()},
+                "clients_waiting": sum(len(lane) for lane in self._lanes.values()),
+                "avg_wait_by_class": {priority: round(wait, 2) for priority, wait in self._avg_wait.items()}
+            }
+
+    def _enqueue(self, ticket):
+        self._lanes[ticket.priority].setdefault(ticket.client, deque()).append(ticket)
+        self._depth += 1
+
+    def _dequeue(self, ticket):
+        """Take one particular waiting ticket out of its client's line."""
+        lane = self._lanes.get(ticket.priority, {})
+        line = lane.get(ticket.client)
+        if line and ticket in line:
+            line.remove(ticket)
+            self._depth -= 1
+            if not line:
+                del lane[ticket.client]
+
+    def _next_waiting(self):
+        """Highest non-empty class; within it, the client whose turn it is."""
+        for lane in self._lanes.values():
+            if lane:
+                client, line = next(iter(lane.items()))
+                ticket = line.popleft()
+                self._depth -= 1
+                if line:
+                    lane.move_to_end(client)
+                else:
+                    del lane[client]
+                return ticket
+        return None
+
+    def _grant_next(self):
+        """Hand idle instances to waiters, interactive requests first."""
+        while self._idle and (self._depth or self._background):
+            self._grant(self._next_waiting() if self._depth else self._background.popleft())
+
+    def _grant(self, ticket):
+        self._active += 1
+        ticket.instance = self._pick_instance(ticket)
+        ticket.started_at = time.time()
+        self._avg_wait[ticket.priority] = 0.8 * self._avg_wait[ticket.priority] + 0.2 * ticket.wait_time
+        ticket.granted.set()
+        if ticket.on_grant:
+            ticket.on_grant(ticket)
+
+    def _pick_instance(self, ticket):
+        """Prefer the idle instance already holding this session's context."""
+        if ticket.affinity:
+            for i, instance in enumerate(self._idle):
+                if instance.context_key and instance.context_key[0] == ticket.affinity:
+                    return self._idle.pop(i)
+        return self._idle.pop()
+
+    def _estimate_wait(self, position):
+        # Only a retry hint, so before any generation has finished a rough guess will do
+        service_time = self._avg_service_time if self._avg_service_time is not None else RETRY_SERVICE_GUESS_SECONDS
+        return max(1, int(service_time * position / max(1, self.slots)))
+
+
+inference_queue = InferenceQueue(MAX_QUEUE_DEPTH)
+
+# Load-adaptive generation budget: answers get shorter as the queue grows so p95 latency
+# stays near LATENCY_SLO_SECONDS, and return to full length once the burst is over
+ADAPTIVE_BUDGET = os.environ.get("ADAPTIVE_BUDGET", "1") == "1"
+LATENCY_SLO_SECONDS = float(os.environ.get("LATENCY_SLO_SECONDS", 30))
+# (name, share of max_tokens / MAX_RESPONSE_CHARS, replay chat history in prompts)
+DEGRADATION_LEVELS = (
+    ("normal", 1.0, True),
+    ("busy", 0.75, True),
+    ("strained", 0.5, True),
+    ("overloaded", 0.25, False),
+)
+# Pressure (predicted or observed latency / SLO) at which levels 1, 2 and 3 kick in
+DEGRADE_THRESHOLDS = (0.6, 0.8, 1.0)
+# Levels drop back one step per this many seconds of lower pressure
+DEGRADE_HOLD_SECONDS = 15
+LATENCY_WINDOW_SECONDS = 60
+
+
+class LoadGovernor:
+    """Chooses each generation's degradation level from queue wait against the latency SLO.
+
+    Levels rise as soon as pressure does and fall back gradually.
+    """
+
+    def __init__(self, slo_seconds):
+        self.slo_seconds = slo_seconds
+        self.level = 0
+        self._changed_at = time.time()
+        self._waits = deque(maxlen=200)
+        self._lock = Lock()
+
+    def observe(self, wait):
+        """Record how long a generation waited in the queue before it started."""
+        with self._lock:
+            self._waits.append((time.time(), wait))
+
+    def _observed_p95(self, now):
+        recent = sorted(wait for at, wait in self._waits if now - at <= LATENCY_WINDOW_SECONDS)
+        return recent[int(0.95 * (len(recent) - 1))] if recent else 0.0
+
+    def _predicted_wait(self):
+        queue = inference_queue.stats()
+        if queue["avg_service_time"] is None:
+            return 0.0
+        return queue["avg_service_time"] * queue["waiting"] / max(1, queue["slots"])
+
+    def pressure(self, now=None):
+        now = now or time.time()
+        return max(self._predicted_wait(), self._observed_p95(now)) / self.slo_seconds
+
+    def current(self):
+        """Degradation level for a generation starting now."""
+        if not ADAPTIVE_BUDGET:
+            return 0
+        with self._lock:
+            now = time.time()
+            target = sum(1 for threshold in DEGRADE_THRESHOLDS if self.pressure(now) >= threshold)
+            if target > self.level:
+                self.level, self._changed_at = target, now
+                print(f"📉 Load is high, shortening answers (level {target}: {DEGRADATION_LEVELS[target][0]})")
+            elif target < self.level:
+                steps = int((now - self._changed_at) // DEGRADE_HOLD_SECONDS)
+                if steps:
+                    self.level, self._changed_at = max(target, self.level - steps), now
+                    print(f"📈 Load eased, answer budget back to level {self.level}: {DEGRADATION_LEVELS[self.level][0]}")
+            return self.level
+
+    def budget(self, adaptive=True):
+        """Generation limits for the current level, or the full budget when not ``adaptive``."""
+        level = self.current() if adaptive else 0
+        name, share, history = DEGRADATION_LEVELS[level]
+        return {
+            "level": level,
+            "name": name,
+            "max_tokens": max(16, int(GENERATION_CONFIG["max_tokens"] * share)),
+            "max_chars": max(256, int(MAX_RESPONSE_CHARS * share)),
+            "history": history
+        }
+
+    def status(self):
+        with self._lock:
+            now = time.time()
+            return {
+                "enabled": ADAPTIVE_BUDGET,
+                "level": self.level,
+                "name": DEGRADATION_LEVELS[self.level][0],
+                "slo_seconds": self.slo_seconds,
+                "pressure": round(self.pressure(now), 2),
+                "predicted_wait": round(self._predicted_wait(), 2),
+                "observed_wait_p95": round(self._observed_p95(now), 2)
+            }
+
+
+load_governor = LoadGovernor(LATENCY_SLO_SECONDS)
+
+# Per-client rate limits for students (0 disables either one); teachers and admins are exempt
+RATE_LIMIT_REQUESTS_PER_MINUTE = float(os.environ.get("RATE_LIMIT_REQUESTS_PER_MINUTE", 12))
+RATE_LIMIT_TOKENS_PER_MINUTE = float(os.environ.get("RATE_LIMIT_TOKENS_PER_MINUTE", 3000))
+# A bucket left alone this long has refilled completely, so it is dropped
+RATE_LIMIT_IDLE_SECONDS = 300
+RATE_LIMIT_SHARDS = 16
+
+
+class RateLimiter:
+    """Per-client token buckets for questions and generated tokens, spread over locked shards."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, idle_seconds=RATE_LIMIT_IDLE_SECONDS, shards=RATE_LIMIT_SHARDS):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.idle_seconds = idle_seconds
+        self._shards = [(Lock(), {}) for _ in range(shards)]
+        self._next_sweep = [0.0] * shards
+
+    @property
+    def enabled(self):
+        return bool(self.requests_per_minute or self.tokens_per_minute)
+
+    def acquire(self, client):
+        """Spend one request for ``client``.
+
+        Returns None when allowed, otherwise (retry_after seconds, "requests"
+        or "tokens") naming the exhausted bucket.
+        """
+        if not self.enabled:
+            return None
+        with self._shard(client) as (buckets, now):
+            bucket = self._refill(buckets, client, now)
+            wait, limit = 0.0, None
+            if self.requests_per_minute and bucket[0] < 1:
+                wait, limit = (1 - bucket[0]) * 60 / self.requests_per_minute, "requests"
+            if self.tokens_per_minute and bucket[1] < 1:
+                token_wait = (1 - bucket[1]) * 60 / self.tokens_per_minute
+                if token_wait > wait:
+                    wait, limit = token_wait, "tokens"
+            if limit:
+                return max(1, math.ceil(wait)), limit
+            bucket[0] -= 1
+            return None
+
+    def charge(self, client, tokens):
+        """Take generated ``tokens`` out of ``client``'s token bucket."""
+        if not self.tokens_per_minute or not tokens:
+            return
+        with self._shard(client) as (buckets, now):
+            self._refill(buckets, client, now)[1] -= tokens
+        RATE_LIMIT_TOKENS.inc(tokens)
+
+    def stats(self):
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "clients_tracked": sum(len(buckets) for _, buckets in self._shards)
+        }
+
+    @contextmanager
+    def _shard(self, client):
+        index = hash(client) % len(self._shards)
+        lock, buckets = self._shards[index]
+        with lock:
+            now = time.monotonic()
+            if now >= self._next_sweep[index]:
+                for idle in [key for key, bucket in buckets.items() if now - bucket[2] >= self.idle_seconds]:
+                    del buckets[idle]
+                self._next_sweep[index] = now + self.idle_seconds / 2
+            yield buckets, now
+
+    def _refill(self, buckets, client, now):
+        """The client's [requests, tokens, updated_at] bucket, topped up to ``now``."""
+        bucket = buckets.get(client)
+        if bucket is None:
+            bucket = buckets[client] = [self.requests_per_minute, self.tokens_per_minute, now]
+        else:
+            minutes = (now - bucket[2]) / 60
+            bucket[0] = min(self.requests_per_minute, bucket[0] + minutes * self.requests_per_minute)
+            bucket[1] = min(self.tokens_per_minute, bucket[1] + minutes * self.tokens_per_minute)
+            bucket[2] = now
+        return bucket
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_REQUESTS_PER_MINUTE, RATE_LIMIT_TOKENS_PER_MINUTE)
+
+
+class ModelInstance:
+    """One loaded copy of the model and its share of the CPU threads."""
+
+    def __init__(self, index, model, n_threads):
+        self.index = index
+        self.model = model
+        self.n_threads = n_threads
+        self.requests_served = 0
+        # (session_id, turns) whose transcript is currently evaluated in the model context
+        self.context_key = None
+        # Context position right after SYSTEM_PROMPT, if it has been snapshotted
+        self.prefix_n_past = None
+        self.prefix_eval_seconds = 0.0
+        self.warmup_seconds = 0.0
+        self.pid = os.getpid()
+        self.restarts = 0
+        # BatchDecoder when several questions decode together on this instance
+        self.batch = None
+        # SpeculativeDecoder when a draft model proposes tokens for this instance
+        self.speculative = None
+
+    @property
+    def supports_context_reuse(self):
+        """True when the backend lets us append to the evaluated context instead of resetting it."""
+        return (self.batch is None and self.speculative is None
+                and hasattr(getattr(self.model, 'model', None), 'prompt_model_streaming'))
+
+    def enable_batching(self, max_sequences):
+        """Decode up to ``max_sequences`` questions together; False if the backend can't.
+
+        Sequences in a batch each keep their own context, so session
+        context reuse and the system prompt snapshot are off for this instance.
+        """
+        if not hasattr(getattr(self.model, 'model', None), 'decode_batch'):
+            return False
+        self.batch = BatchDecoder(self.model.model, max_sequences)
+        return True
+
+    @property
+    def supports_speculation(self):
+        """True when the backend can verify a draft model's tokens in one pass."""
+        return hasattr(getattr(self.model, 'model', None), 'verify_tokens')
+
+    def enable_speculation(self, draft):
+        """Let ``draft`` propose tokens for this instance to verify.
+
+        Like batching, this gives each answer a sequence of its own, so
+        context reuse and the system prompt snapshot are off for this instance.
+        """
+        self.speculative = SpeculativeDecoder(self.model.model, draft, DRAFT_TOKENS)
+
+    def snapshot_prefix(self, prefix):
+        """Evaluate ``prefix`` once and remember the context position after it.
+
+        llama.cpp keeps the KV cache for every evaluated position, so rolling
+        n_past back to this point later restores the prefix state for free.
+        """
+        if not prefix or not self.supports_context_reuse:
+            return
+        start_time = time.time()
+        for _ in self.model.model.prompt_model_streaming(prefix, RAW_PROMPT_TEMPLATE, keep_generating, reset_context=True,
+                                                         n_predict=0, n_batch=GENERATION_CONFIG["n_batch"]):
+            pass
+        context = getattr(self.model.model, 'context', None)
+        if context is not None and getattr(context, 'n_past', 0) > 0:
+            self.prefix_n_past = context.n_past
+            self.prefix_eval_seconds = time.time() - start_time
+
+    def set_threads(self, n_threads):
+        """Change the backend's thread count in place (used by the autotuner)."""
+        self.model.model.set_thread_count(n_threads)
+        self.n_threads = n_threads
+
+    def warm_up(self, prompt, max_tokens):
+        """Run one throwaway generation so the weights are paged in before real users arrive."""
+        if max_tokens <= 0:
+            return
+        start_time = time.time()
+        for _ in self.generate(prompt, **dict(GENERATION_CONFIG, max_tokens=max_tokens)):
+            pass
+        self.requests_served = 0
+        self.warmup_seconds = time.time() - start_time
+
+    def generate(self, prompt, reset_context=True, callback=None, **config):
+        """Stream a completion of SYSTEM_PROMPT + ``prompt``.
+
+        With ``reset_context`` the context starts over: from the prefix
+        snapshot when there is one, otherwise by evaluating the full text.
+        Without it, ``prompt`` is appended to whatever the context holds.
+        The backend calls ``callback(token_id, text)`` per token and stops
+        generating as soon as it returns False.
+        """
+        callback = callback or keep_generating
+        self.requests_served += 1
+        if self.batch:
+            return self.batch.generate(SYSTEM_PROMPT + prompt, callback, **config)
+        if self.speculative:
+            return self.speculative.generate(SYSTEM_PROMPT + prompt, callback, **config)
+        if reset_context:
+            self.context_key = None
+            if self.prefix_n_past is None:
+                return self.model.generate(SYSTEM_PROMPT + prompt, streaming=True, callback=callback, **config)
+            self.model.model.context.n_past = self.prefix_n_past
+
+        # Continue from the tokens already in the context; only ``prompt`` gets evaluated
+        kwargs = dict(config)
+        kwargs['n_predict'] = kwargs.pop('max_tokens')
+        return self.model.model.prompt_model_streaming(prompt, RAW_PROMPT_TEMPLATE, callback, reset_context=False, **kwargs)
+
+
+# llmodel prompt template that passes our already formatted prompt through unchanged
+RAW_PROMPT_TEMPLATE = "%1"
+
+
+def keep_generating(token_id, response):
+    """Backend callback that never asks generation to stop early."""
+    return True
+
+
+# Continuous batching: up to this many questions decode together on one instance (1 = off).
+# Needs a backend with multi-sequence decoding; others answer one question at a time.
+BATCH_SEQUENCES = max(1, int(os.environ.get("BATCH_SEQUENCES", 1)))
+
+
+class BatchDecoder:
+    """Continuous batching: each step decodes one token for every active sequence of one model.
+
+    The backend needs add_sequence(seq_id, prompt, **sampling), decode_batch(seq_ids) and remove_sequence(seq_id).
+    """
+
+    def __init__(self, model, max_sequences):
+        self.model = model
+        self.max_sequences = max_sequences
+        self.steps = 0
+        self.tokens = 0
+        self._next_id = 0
+        self._joining = []
+        self._active = {}
+        self._cond = Condition()
+        Thread(target=self._loop, name="batch-decoder", daemon=True).start()
+
+    @property
+    def active(self):
+        return len(self._active)
+
+    def generate(self, prompt, callback, max_tokens, **sampling):
+        """Stream a completion of ``prompt``; ``callback(token_id, text)`` returning False ends it."""
+        tokens = Queue()
+        with self._cond:
+            self._joining.append({"id": self._next_id, "prompt": prompt, "callback": callback, "sampling": sampling,
+                                  "max_tokens": max_tokens, "count": 0, "tokens": tokens})
+            self._next_id += 1
+            self._cond.notify()
+        return self._follow(tokens)
+
+    @staticmethod
+    def _follow(tokens):
+        while True:
+            token = tokens.get()
+            if token is None:
+                return
+            if isinstance(token, Exception):
+                raise token
+            yield token
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._joining and not self._active:
+                    self._cond.wait()
+                room = self.max_sequences - len(self._active)
+                joining, self._joining = self._joining[:room], self._joining[room:]
+            for sequence in joining:
+                # Each joiner on its own, so one bad prompt fails only its own caller
+                self._active[sequence["id"]] = sequence
+                try:
+                    self.model.add_sequence(sequence["id"], sequence["prompt"], **sequence["sampling"])
+                except Exception as e:
+                    print(f"❌ Sequence {sequence['id']} couldn't join the batch: {e}")
+                    self._end(sequence["id"], e)
+            if not self._active:
+                continue
+            try:
+                decoded = self.model.decode_batch(list(self._active))
+            except Exception as e:
+                print(f"❌ Batched decoding failed: {e}")
+                for seq_id in list(self._active):
+                    self._end(seq_id, e)
+                continue
+            self.steps += 1
+            self.tokens += len(decoded)
+            for seq_id, token in decoded.items():
+                sequence = self._active.get(seq_id)
+                if sequence is None:
+                    continue
+                try:
+                    stop = token is None or sequence["callback"](sequence["count"], token) is False
+                except Exception as e:
+                    self._end(seq_id, e)
+                    continue
+                if stop:
+                    self._end(seq_id)
+                    continue
+                sequence["count"] += 1
+                sequence["tokens"].put(token)
+                if sequence["count"] >= sequence["max_tokens"]:
+                    self._end(seq_id)
+
+    def _end(self, seq_id, error=None):
+        sequence = self._active.pop(seq_id)
+        try:
+            self.model.remove_sequence(seq_id)
+        except Exception as e:
+            # The caller still gets its answer (or error); the loop keeps serving the rest
+            print(f"⚠️ Couldn't remove sequence {seq_id} from the batch: {e}")
+        sequence["tokens"].put(error)
+
+    def stats(self):
+        return {
+            "max_sequences": self.max_sequences,
+            "active": self.active,
+            "steps": self.steps,
+            "avg_batch": round(self.tokens / self.steps, 2) if self.steps else 0.0
+        }
+
+
+# Speculative decoding: a small draft model (a file name in the gpt4all model folder or a
+# path, "" = off) guesses the next DRAFT_TOKENS tokens and the main model checks them all in one pass
+DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME", "")
+DRAFT_TOKENS = max(1, int(os.environ.get("DRAFT_TOKENS", 4)))
+if DRAFT_MODEL_NAME and MODEL_BACKEND != "fake":
+    # gpt4all's LLModel can neither draft nor verify several tokens, so there is nothing to run this on
+    if WORKER_INDEX is None:
+        print(f"❌ DRAFT_MODEL_NAME is set, but the {MODEL_BACKEND} backend has no speculative decoding; ignoring it")
+    DRAFT_MODEL_NAME = ""
+
+
+class SpeculativeDecoder:
+    """Speculative decoding: a draft model proposes tokens and the main model verifies them in one pass.
+
+    The draft returns (token, probability) pairs that verify_tokens() checks with speculative sampling.
+    """
+
+    def __init__(self, model, draft, draft_tokens):
+        self.model = model
+        self.draft = draft
+        self.draft_tokens = draft_tokens
+        self.passes = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.tokens = 0
+        self._next_id = 0
+        self._lock = Lock()
+
+    def generate(self, prompt, callback, max_tokens, **sampling):
+        """Stream a completion of ``prompt``; ``callback(token_id, text)`` returning False ends it."""
+        with self._lock:
+            seq_id = self._next_id
+            self._next_id += 1
+        self.model.add_sequence(seq_id, prompt, **sampling)
+        self.draft.add_sequence(seq_id, prompt, **sampling)
+        count = 0
+        try:
+            while count < max_tokens:
+                # The main model always adds a token of its own, so leave room for it
+                proposed = self.draft.draft_tokens(seq_id, min(self.draft_tokens, max_tokens - count - 1))
+                accepted, tokens = self.model.verify_tokens(seq_id, proposed)
+                self.draft.accept(seq_id, tokens)
+                with self._lock:
+                    self.passes += 1
+                    self.proposed += len(proposed)
+                    self.accepted += accepted
+                    self.tokens += len(tokens)
+                for token in tokens:
+                    if token is None or count >= max_tokens or callback(count, token) is False:
+                        return
+                    count += 1
+                    yield token
+        finally:
+            self.model.remove_sequence(seq_id)
+            self.draft.remove_sequence(seq_id)
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    def stats(self):
+        return {
+            "draft_model": DRAFT_MODEL_NAME,
+            "draft_tokens": self.draft_tokens,
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "acceptance_rate": round(self.acceptance_rate, 3),
+            "tokens_per_pass": round(self.tokens / self.passes, 2) if self.passes else 0.0
+        }
+
+
+# Stand-in model for load tests: sleeps instead of computing, same streaming interface
+FAKE_TOKEN_DELAY = float(os.environ.get("FAKE_TOKEN_DELAY", 0.05))
+FAKE_PROMPT_EVAL_DELAY = float(os.environ.get("FAKE_PROMPT_EVAL_DELAY", 0.002))
+FAKE_ANSWER_TOKENS = int(os.environ.get("FAKE_ANSWER_TOKENS", 64))
+FAKE_LOAD_SECONDS = float(os.environ.get("FAKE_LOAD_SECONDS", 0))
+# Share of FAKE_TOKEN_DELAY each extra token evaluated in the same pass adds (another
+# sequence in a batch, or a draft token being verified)
+FAKE_BATCH_TOKEN_COST = float(os.environ.get("FAKE_BATCH_TOKEN_COST", 0.1))
+# Stand-in draft model: seconds per proposed token and how often its guess is right
+FAKE_DRAFT_TOKEN_DELAY = float(os.environ.get("FAKE_DRAFT_TOKEN_DELAY", 0.005))
+FAKE_DRAFT_ACCEPT_RATE = float(os.environ.get("FAKE_DRAFT_ACCEPT_RATE", 0.7))
+# Optional file the stand-in maps and pages in like real weights, to check memory sharing
+FAKE_WEIGHTS_FILE = os.environ.get("FAKE_WEIGHTS_FILE")
+FAKE_VOCABULARY = ("the", "model", "answer", "offline", "edge", "light", "energy", "plant",
+                   "water", "data", "zoho", "student", "simple", "because", "and", "is")
+
+
+def fake_token(seed, i):
+    """The stand-in model's ``i``-th answer token for a prompt hashing to ``seed`` (None past the end)."""
+    if i >= FAKE_ANSWER_TOKENS:
+        return None
+    return " " + FAKE_VOCABULARY[(seed + i * 7) % len(FAKE_VOCABULARY)]
+
+
+class FakePromptContext:
+    def __init__(self):
+        self.n_past = 0
+
+
+class FakeLLModel:
+    """Mimics the parts of gpt4all's low-level LLModel that Zia Edge calls.
+
+    Prompt evaluation costs FAKE_PROMPT_EVAL_DELAY per (estimated) prompt
+    token and each generated token costs FAKE_TOKEN_DELAY. Output is a
+    deterministic function of the prompt so repeated runs are comparable.
+    """
+
+    def __init__(self, n_threads=1):
+        self.context = FakePromptContext()
+        self.n_threads = n_threads
+        # seq_id -> [seed, tokens decoded, prompt tokens still to evaluate]
+        self.sequences = {}
+        # seq_id -> the sampling settings it was added with
+        self.sampling = {}
+
+    def set_thread_count(self, n_threads):
+        self.n_threads = n_threads
+
+    def thread_count(self):
+        return self.n_threads
+
+    def prompt_model_streaming(self, prompt, prompt_template, callback=keep_generating, reset_context=False, n_predict=128, **kwargs):
+        if reset_context:
+            self.context.n_past = 0
+        prompt_tokens = len(prompt) // 4 + 1
+        time.sleep(prompt_tokens * FAKE_PROMPT_EVAL_DELAY)
+        self.context.n_past += prompt_tokens
+
+        seed = zlib.crc32(prompt.encode('utf-8'))
+        for i in range(min(n_predict, FAKE_ANSWER_TOKENS)):
+            time.sleep(FAKE_TOKEN_DELAY)
+            self.context.n_past += 1
+            token = fake_token(seed, i)
+            if callback(i, token) is False:
+                break
+            yield token
+
+    # Multi-sequence decoding for BatchDecoder: each sequence keeps its own position, and
+    # a step costs one token's delay plus FAKE_BATCH_TOKEN_COST of it per extra sequence
+
+    def add_sequence(self, seq_id, prompt, **sampling):
+        self.sequences[seq_id] = [zlib.crc32(prompt.encode('utf-8')), 0, len(prompt) // 4 + 1]
+        self.sampling[seq_id] = sampling
+
+    def decode_batch(self, seq_ids):
+        prefill = sum(self.sequences[seq_id][2] for seq_id in seq_ids)
+        time.sleep(prefill * FAKE_PROMPT_EVAL_DELAY + FAKE_TOKEN_DELAY * (1 + FAKE_BATCH_TOKEN_COST * (len(seq_ids) - 1)))
+        decoded = {}
+        for seq_id in seq_ids:
+            sequence = self.sequences[seq_id]
+            seed, i = sequence[0], sequence[1]
+            sequence[1:] = [i + 1, 0]
+            decoded[seq_id] = fake_token(seed, i)
+        return decoded
+
+    def verify_tokens(self, seq_id, proposed):
+        """Check draft (token, probability) pairs in one pass: the accepted prefix plus this model's own next token.
+
+        This model gives its next token probability 1 and every other token 0,
+        so speculative sampling keeps a guess exactly when it matches.
+        """
+        sequence = self.sequences[seq_id]
+        seed, i, prefill = sequence
+        time.sleep(prefill * FAKE_PROMPT_EVAL_DELAY + FAKE_TOKEN_DELAY * (1 + FAKE_BATCH_TOKEN_COST * len(proposed)))
+        tokens = []
+        for token, probability in proposed:
+            if token is None or token != fake_token(seed, i + len(tokens)):
+                break
+            tokens.append(token)
+        accepted = len(tokens)
+        tokens.append(fake_token(seed, i + accepted))
+        sequence[1:] = [i + accepted + 1, 0]
+        return accepted, tokens
+
+    def remove_sequence(self, seq_id):
+        self.sequences.pop(seq_id, None)
+        self.sampling.pop(seq_id, None)
+
+
+class FakeDraftLLModel:
+    """Stand-in draft model: guesses the fake main model's next tokens, right FAKE_DRAFT_ACCEPT_RATE of the time."""
+
+    def __init__(self):
+        # seq_id -> [seed, tokens accepted so far]
+        self.sequences = {}
+
+    def add_sequence(self, seq_id, prompt, **sampling):
+        self.sequences[seq_id] = [zlib.crc32(prompt.encode('utf-8')), 0]
+
+    def draft_tokens(self, seq_id, count):
+        seed, i = self.sequences[seq_id]
+        time.sleep(count * FAKE_DRAFT_TOKEN_DELAY)
+        guesses = []
+        for n in range(i, i + count):
+            right = zlib.crc32(f"{seed}:{n}".encode()) % 1000 < FAKE_DRAFT_ACCEPT_RATE * 1000
+            guesses.append((fake_token(seed, n) if right else " um", 1.0))
+        return guesses
+
+    def accept(self, seq_id, tokens):
+        self.sequences[seq_id][1] += len(tokens)
+
+    def remove_sequence(self, seq_id):
+        self.sequences.pop(seq_id, None)
+
+
+class FakeGPT4All:
+    """Drop-in for GPT4All selected with MODEL_BACKEND=fake."""
+
+    def __init__(self, model_name, n_threads=None):
+        time.sleep(FAKE_LOAD_SECONDS)
+        self.model_name = model_name
+        self.model = FakeLLModel(n_threads or 1)
+        self.weights = None
+        if FAKE_WEIGHTS_FILE:
+            with open(FAKE_WEIGHTS_FILE, 'rb') as f:
+                self.weights = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Touch every page, as a real model load does
+            sum(self.weights[i] for i in range(0, len(self.weights), mmap.PAGESIZE))
+
+    def generate(self, prompt, max_tokens=200, streaming=False, callback=keep_generating, **kwargs):
+        tokens = self.model.prompt_model_streaming(prompt, RAW_PROMPT_TEMPLATE, callback, reset_context=True, n_predict=max_tokens)
+        return tokens if streaming else ''.join(tokens)
+
+
+def load_model(n_threads):
+    """Construct one model object for the configured MODEL_BACKEND."""
+    if MODEL_BACKEND == "fake":
+        return FakeGPT4All(MODEL_NAME, n_threads=n_threads)
+    if GPT4All is None:
+        raise RuntimeError("gpt4all is not installed (pip install -r static/requirements.txt)")
+    return GPT4All(MODEL_NAME, n_threads=n_threads)
+
+
+def draft_model_path():
+    """Where the DRAFT_MODEL_NAME file lives: a path as given, otherwise in the gpt4all model folder."""
+    if os.path.dirname(DRAFT_MODEL_NAME):
+        return os.path.expanduser(DRAFT_MODEL_NAME)
+    return os.path.join(os.path.expanduser("~"), ".cache", "gpt4all", DRAFT_MODEL_NAME)
+
+
+def load_draft_model():
+    """The fake backend's draft model, or None (saying why) when the draft file is missing."""
+    path = draft_model_path()
+    if not os.path.isfile(path):
+        print(f"⚠️ Draft model {path} not found, using plain generation")
+        return None
+    return FakeDraftLLModel()
+
+
+def model_file_path():
+    """Where the weights the backend will map live, or None if there are none."""
+    if MODEL_BACKEND == "fake":
+        return FAKE_WEIGHTS_FILE
+    return os.path.join(os.path.expanduser("~"), ".cache", "gpt4all", MODEL_NAME)
+
+
+def prefetch_model_file(path):
+    """Ask the kernel to start reading ``path`` into the page cache.
+
+    Every instance maps the same file, so the pages read here are the ones
+    they all share. Returns the mapping (kept open so the pages stay
+    referenced) or None where the file or madvise is unavailable.
+    """
+    if not path or not os.path.exists(path) or not hasattr(mmap, 'MADV_WILLNEED'):
+        return None
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    mapping.madvise(mmap.MADV_WILLNEED)
+    print(f"📦 Prefetching {len(mapping) / 1024 ** 3:.1f} GB of model weights into the shared page cache")
+    return mapping
+
+
+def process_memory(pid, mapped_path=None):
+    """RSS split into shared and private memory for ``pid``, from /proc (Linux only).
+
+    ``pss_mb`` charges shared pages to each process that maps them in equal
+    parts, so summed over all processes it is the real total.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            # The first line is the address range header of the rolled-up mappings
+            fields = dict(line.split(':', 1) for line in f.read().splitlines()[1:])
+    except OSError:
+        return None
+    kb = lambda name: int(fields.get(name, "0 kB").split()[0])
+    memory = {
+        "rss_mb": round(kb("Rss") / 1024, 1),
+        "pss_mb": round(kb("Pss") / 1024, 1),
+        "shared_mb": round((kb("Shared_Clean") + kb("Shared_Dirty")) / 1024, 1),
+        "private_mb": round((kb("Private_Clean") + kb("Private_Dirty")) / 1024, 1)
+    }
+    if mapped_path:
+        try:
+            with open(f"/proc/{pid}/maps") as f:
+                memory["weights_mapped"] = any(line.rstrip().endswith(mapped_path) for line in f)
+        except OSError:
+            memory["weights_mapped"] = None
+    return memory
+
+
+def total_memory_gb():
+    """Physical RAM in GB, or None where the platform does not expose it."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 ** 3)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def resolve_model_instances(setting):
+    """Turn MODEL_INSTANCES ("auto" or a number) into an instance count for this machine."""
+    if setting.strip().lower() != "auto":
+        return max(1, min(int(setting), CPU_THREADS))
+
+    # One instance per ~8 cores, but never more than fit in RAM next to the OS; the
+    # weights are shared, so only the first instance pays for them
+    by_cpu = max(1, CPU_THREADS // 8)
+    memory = total_memory_gb()
+    by_ram = max(1, 1 + int((memory - 2 - MODEL_RAM_GB) // INSTANCE_RAM_GB)) if memory else 1
+    return min(by_cpu, by_ram)
+
+
+def partition_threads(total, parts):
+    """Split the CPU thread budget as evenly as possible across instances."""
+    base, extra = divmod(total, parts)
+    return [max(1, base + (1 if i < extra else 0)) for i in range(parts)]
+
+
+# Run each model instance in its own process so a native crash or OOM kill in llama.cpp
+# costs one generation instead of the whole web server
+WORKER_PROCESSES = os.environ.get("WORKER_PROCESSES", "0") == "1"
+WORKER_HEALTH_INTERVAL_SECONDS = 5
+# A worker that has not answered a ping for this long is killed and restarted
+WORKER_HEALTH_TIMEOUT_SECONDS = 30
+WORKER_MAX_RESTART_DELAY = 60
+
+
+class WorkerInstance:
+    """A model instance living in a child process, with ModelInstance's interface.
+
+    The child is this file started with ZIA_WORKER_INDEX set (see run_worker).
+    Requests go down its stdin and replies come back on its stdout, one JSON
+    object per line; a generation streams one line per token and can be
+    cancelled mid-way. If the child dies, the generation in progress fails,
+    the evaluated context is forgotten and a replacement is started with the
+    same system prompt snapshot and warm-up. Questions granted this instance
+    in the meantime wait for the replacement instead of failing.
+    """
+
+    def __init__(self, index, n_threads):
+        self.index = index
+        self.n_threads = n_threads
+        self.requests_served = 0
+        self.context_key = None
+        self.prefix_n_past = None
+        self.prefix_eval_seconds = 0.0
+        self.warmup_seconds = 0.0
+        self.supports_context_reuse = False
+        self.batch = None
+        self.speculative = None
+        self.pid = None
+        self.restarts = 0
+        self.last_pong = time.time()
+        self._process = None
+        self._calls = {}
+        self._next_call = 0
+        self._lock = Lock()
+        self._running = Event()
+        # Replayed into a restarted worker before it takes questions again
+        self._prefix = None
+        self._warmup = None
+        self._start()
+        self._running.set()
+
+    def generate(self, prompt, reset_context=True, callback=None, **config):
+        """Stream a completion from the worker; see ModelInstance.generate."""
+        self.requests_served += 1
+        if reset_context:
+            self.context_key = None
+        return self._stream({"op": "generate", "prompt": prompt, "reset_context": reset_context, "config": config},
+                            callback or keep_generating)
+
+    def snapshot_prefix(self, prefix):
+        if not prefix:
+            return
+        self._prefix = prefix
+        result = self._call({"op": "snapshot", "prefix": prefix})
+        self.prefix_n_past, self.prefix_eval_seconds = result["prefix_n_past"], result["prefix_eval_seconds"]
+
+    def warm_up(self, prompt, max_tokens):
+        self._warmup = (prompt, max_tokens)
+        self.warmup_seconds = self._call({"op": "warm_up", "prompt": prompt, "max_tokens": max_tokens})["warmup_seconds"]
+        self.requests_served = 0
+
+    def set_threads(self, n_threads):
+        self._call({"op": "set_threads", "n_threads": n_threads})
+        self.n_threads = n_threads
+
+    def check_health(self):
+        """Ping the worker, killing it if earlier pings went unanswered for too long."""
+        process = self._process
+        if not self._running.is_set() or process is None or process.poll() is not None:
+            return
+        if time.time() - self.last_pong > WORKER_HEALTH_TIMEOUT_SECONDS:
+            print(f"🩺 Model worker {self.index + 1} stopped answering pings, killing it")
+            self._kill(process, "unresponsive")
+            return
+        self._send({"op": "ping"})
+
+    def _start(self):
+        """Launch a worker process and wait for its model to load."""
+        env = dict(os.environ, ZIA_WORKER_INDEX=str(self.index), ZIA_WORKER_THREADS=str(self.n_threads))
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, env=env, text=True, encoding='utf-8', bufsize=1)
+        hello = json.loads(process.stdout.readline() or '{}')
+        if hello.get("op") != "ready":
+            process.kill()
+            process.wait()
+            raise RuntimeError(hello.get("error") or f"model worker exited with code {process.returncode} while loading")
+        with self._lock:
+            self._process = process
+            self.pid = process.pid
+            self.supports_context_reuse = hello["context_reuse"]
+            self.last_pong = time.time()
+        Thread(target=self._read, args=(process,), name=f"worker-{self.index}-reader", daemon=True).start()
+
+    def _read(self, process):
+        """Route the worker's replies to the calls waiting for them, then handle its exit."""
+        for line in process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                # One garbled line shouldn't take the reader (and every call after it) down with it
+                print(f"⚠️ Model worker {self.index + 1} sent a line that isn't JSON, skipping it: {line[:200]!r}")
+                continue
+            if not isinstance(message, dict):
+                print(f"⚠️ Model worker {self.index + 1} sent an unexpected message, skipping it: {line[:200]!r}")
+                continue
+            if message.get("op") == "pong":
+                self.last_pong = time.time()
+                continue
+            replies = self._calls.get(message.get("id"))
+            if replies is not None:
+                replies.put(message)
+        code = process.wait()
+
+        with self._lock:
+            if process is not self._process:
+                return
+            # A worker dying while it is being restarted is retried by the restart itself
+            restarting = not self._running.is_set()
+            self._process = None
+            self._running.clear()
+            # Whatever the context held went with the process
+            self.context_key = None
+            self.prefix_n_past = None
+            calls, self._calls = list(self._calls.values()), {}
+        for replies in calls:
+            replies.put({"error": f"The AI model process stopped unexpectedly (exit code {code}). Please try again."})
+        if restarting:
+            return
+        if getattr(process, "kill_reason", None) is None:
+            WORKER_RESTARTS.inc(reason="crashed")
+        print(f"💥 Model worker {self.index + 1} (pid {process.pid}) exited with code {code}, restarting it")
+        Thread(target=self._restart, name=f"worker-{self.index}-restart", daemon=True).start()
+
+    def _restart(self):
+        delay = 1
+        while True:
+            try:
+                self._start()
+                if self._prefix:
+                    self.snapshot_prefix(self._prefix)
+                if self._warmup:
+                    self.warm_up(*self._warmup)
+                break
+            except Exception as e:
+                print(f"❌ Model worker {self.index + 1} failed to restart ({e}), retrying in {delay}s")
+                time.sleep(delay)
+                delay = min(delay * 2, WORKER_MAX_RESTART_DELAY)
+        self.restarts += 1
+        self._running.set()
+        print(f"✅ Model worker {self.index + 1} is back (pid {self.pid})")
+
+    def _kill(self, process, reason):
+        process.kill_reason = reason
+        WORKER_RESTARTS.inc(reason=reason)
+        process.kill()
+
+    def _send(self, message):
+        with self._lock:
+            process = self._process
+            if process is None:
+                return False
+            try:
+                process.stdin.write(json.dumps(message) + "\n")
+                process.stdin.flush()
+                return True
+            except (BrokenPipeError, OSError, ValueError):
+                return False
+
+    def _call(self, message):
+        """Run a request that returns no tokens and give back its result."""
+        result = {}
+        for _ in self._stream(message, keep_generating, wait_ready=False, result=result):
+            pass
+        return result
+
+    def _stream(self, message, callback, wait_ready=True, result=None):
+        """Send one request and yield the tokens it streams back.
+
+        ``callback(index, token)`` returning False cancels the request in the
+        worker; the tokens still in the pipe are drained without being yielded.
+        """
+        if wait_ready and not self._running.wait(WORKER_MAX_RESTART_DELAY * 2):
+            raise RuntimeError("The AI model process is restarting. Please try again shortly.")
+        replies = Queue()
+        with self._lock:
+            self._next_call += 1
+            call_id = message["id"] = self._next_call
+            self._calls[call_id] = replies
+        cancelled = False
+        count = 0
+        try:
+            if not self._send(message):
+                raise RuntimeError("The AI model process is not running. Please try again shortly.")
+            while True:
+                try:
+                    reply = replies.get(timeout=GENERATION_TIMEOUT_SECONDS)
+                except Empty:
+                    # The worker still answers pings but this generation has gone silent
+                    process = self._process
+                    if process is not None:
+                        print(f"🩺 Model worker {self.index + 1} stalled, killing it")
+                        self._kill(process, "stalled")
+                    raise RuntimeError("The AI model stopped responding. Please try again.")
+                if "error" in reply:
+                    raise RuntimeError(reply["error"])
+                if "token" in reply:
+                    if not cancelled and callback(count, reply["token"]) is False:
+                        cancelled = self._send({"op": "cancel", "id": call_id}) or True
+                    count += 1
+                    if not cancelled:
+                        yield reply["token"]
+                    continue
+                if result is not None:
+                    result.update(reply)
+                return
+        finally:
+            with self._lock:
+                self._calls.pop(call_id, None)
+
+
+def supervise_workers():
+    """Health-check worker processes for as long as the server runs."""
+    while True:
+        time.sleep(WORKER_HEALTH_INTERVAL_SECONDS)
+        for instance in list(model_instances):
+            try:
+                instance.check_health()
+            except Exception as e:
+                print(f"⚠️ Worker health check failed: {e}")
+
+
+# Startup autotuner: calibrates thread count and n_batch, persisted per machine and model.
+# "auto" reuses a saved profile, "on" also calibrates when there is none,
+# "force" always recalibrates and "off" ignores saved profiles.
+AUTOTUNE_MODE = os.environ.get("MODEL_AUTOTUNE", "auto").lower()
+AUTOTUNE_FILE = os.environ.get("AUTOTUNE_FILE", os.path.join(os.path.expanduser("~"), ".cache", "zia-edge", "autotune.json"))
+AUTOTUNE_BATCH_SIZES = (8, 16, 32, 64, 128, 256)
+AUTOTUNE_DECODE_TOKENS = 16
+AUTOTUNE_PROMPT = "User: " + "Explain how plants turn sunlight, water and air into food. " * 12 + "\nAssistant:"
+# Prompt length of a typical question, used to weigh prompt-eval speed against decode speed
+TYPICAL_PROMPT_TOKENS = 256
+# A candidate must beat the current pick by this much to replace it, so noise doesn't flip settings
+AUTOTUNE_MIN_GAIN = 0.03
+
+
+def physical_cores():
+    """Physical core count from /proc/cpuinfo, falling back to the logical count."""
+    cores = set()
+    try:
+        with open('/proc/cpuinfo', encoding='utf-8') as f:
+            physical_id = None
+            for line in f:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key == 'physical id':
+                    physical_id = value.strip()
+                elif key == 'core id':
+                    cores.add((physical_id, value.strip()))
+    except OSError:
+        pass
+    return len(cores) or os.cpu_count() or 1
+
+
+def thread_candidates():
+    """Thread counts worth trying: around the physical and the logical core counts."""
+    logical = os.cpu_count() or 1
+    physical = physical_cores()
+    return sorted({n for n in (physical // 2, physical - 1, physical, logical - 1, logical) if n >= 1})
+
+
+def machine_key():
+    """Identifies this machine and model in the autotune file."""
+    return f"{socket.gethostname()}|{platform.machine()}|{os.cpu_count()} cpus|{MODEL_BACKEND}:{MODEL_NAME}"
+
+
+def load_tuning_profile():
+    try:
+        with open(AUTOTUNE_FILE, encoding='utf-8') as f:
+            return json.load(f).get(machine_key())
+    except (OSError, ValueError):
+        return None
+
+
+def save_tuning_profile(profile):
+    try:
+        with open(AUTOTUNE_FILE, encoding='utf-8') as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        profiles = {}
+    profiles[machine_key()] = profile
+    os.makedirs(os.path.dirname(AUTOTUNE_FILE) or '.', exist_ok=True)
+    with open(AUTOTUNE_FILE + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(AUTOTUNE_FILE + '.tmp', AUTOTUNE_FILE)
+
+
+def apply_tuning_profile(profile, source):
+    """Use a profile's settings unless MODEL_THREADS / MODEL_N_BATCH were set explicitly."""
+    global CPU_THREADS
+    if "MODEL_THREADS" not in os.environ:
+        CPU_THREADS = profile["threads"]
+    if "MODEL_N_BATCH" not in os.environ:
+        GENERATION_CONFIG["n_batch"] = profile["n_batch"]
+    tuning.update(source=source, profile=profile)
+
+
+def measure_speed(instance, n_batch):
+    """Prompt-eval and decode tokens/sec of one calibration generation."""
+    llm = instance.model.model
+    start = time.perf_counter()
+    first_token = None
+    generated = 0
+    for _ in llm.prompt_model_streaming(AUTOTUNE_PROMPT, RAW_PROMPT_TEMPLATE, keep_generating, reset_context=True,
+                                        n_predict=AUTOTUNE_DECODE_TOKENS, n_batch=n_batch):
+        if first_token is None:
+            first_token = time.perf_counter()
+        generated += 1
+    end = time.perf_counter()
+    instance.context_key = None
+
+    prompt_tokens = max(1, llm.context.n_past - generated)
+    prompt_seconds = (first_token or end) - start
+    decode_seconds = end - first_token if first_token else 0
+    return {
+        "prompt_tokens_per_second": round(prompt_tokens / prompt_seconds, 2) if prompt_seconds > 0 else 0.0,
+        "decode_tokens_per_second": round((generated - 1) / decode_seconds, 2) if generated > 1 and decode_seconds > 0 else 0.0
+    }
+
+
+def expected_request_seconds(result):
+    """Time a typical question would take at the measured speeds."""
+    if not result["prompt_tokens_per_second"] or not result["decode_tokens_per_second"]:
+        return float('inf')
+    return (TYPICAL_PROMPT_TOKENS / result["prompt_tokens_per_second"]
+            + GENERATION_CONFIG["max_tokens"] / result["decode_tokens_per_second"])
+
+
+def fastest(results):
+    """The earliest result no later one beats by more than AUTOTUNE_MIN_GAIN."""
+    best = results[0]
+    for result in results[1:]:
+        if expected_request_seconds(result) < expected_request_seconds(best) * (1 - AUTOTUNE_MIN_GAIN):
+            best = result
+    return best
+
+
+def autotune(instance):
+    """Calibrate thread count, then n_batch, on ``instance`` and return the winning profile.
+
+    Decode speed depends on the thread count only, while n_batch only changes
+    prompt evaluation, so the two are swept one after the other. Ties go to
+    fewer threads and to the configured n_batch.
+    """
+    candidates = thread_candidates()
+    print(f"🎛️ Autotuning: threads {candidates}, n_batch {list(AUTOTUNE_BATCH_SIZES)}")
+    default_batch = GENERATION_CONFIG["n_batch"]
+    measure_speed(instance, default_batch)  # throwaway run so cold pages don't skew the first candidate
+
+    results = []
+
+    def run(threads, n_batch):
+        result = dict(threads=threads, n_batch=n_batch, **measure_speed(instance, n_batch))
+        results.append(result)
+        print(f"   threads {threads:>3} • n_batch {n_batch:>4} → prompt {result['prompt_tokens_per_second']:>8.1f} tok/s • decode {result['decode_tokens_per_second']:>6.1f} tok/s")
+        return result
+
+    for threads in candidates:
+        instance.set_threads(threads)
+        run(threads, default_batch)
+    best_threads = fastest(results)["threads"]
+
+    instance.set_threads(best_threads)
+    for n_batch in AUTOTUNE_BATCH_SIZES:
+        if n_batch != default_batch:
+            run(best_threads, n_batch)
+    best = fastest([r for r in results if r["threads"] == best_threads])
+
+    if instance.prefix_n_past is not None:
+        instance.prefix_n_past = None
+        instance.snapshot_prefix(SYSTEM_PROMPT)
+    print(f"🎛️ Best: {best['threads']} threads, n_batch {best['n_batch']} "
+          f"({best['prompt_tokens_per_second']} prompt tok/s, {best['decode_tokens_per_second']} decode tok/s)")
+    return {
+        "threads": best["threads"],
+        "n_batch": best["n_batch"],
+        "physical_cores": physical_cores(),
+        "logical_cores": os.cpu_count(),
+        "tuned_at": datetime.datetime.now().isoformat(),
+        "candidates": results
+    }
+
+
+def calibrate(instance):
+    """Autotune on ``instance``, persist the result and switch to it."""
+    profile = autotune(instance)
+    try:
+        save_tuning_profile(profile)
+        print(f"💾 Autotune profile saved to {AUTOTUNE_FILE}")
+    except OSError as e:
+        print(f"⚠️ Could not save the autotune profile: {e}")
+    apply_tuning_profile(profile, "calibrated")
+    return profile
+
+
+tuning = {"source": "default", "profile": None}
+if AUTOTUNE_MODE in ("auto", "on"):
+    saved_profile = load_tuning_profile()
+    if saved_profile:
+        apply_tuning_profile(saved_profile, "saved")
+        print(f"🎛️ Using saved autotune profile: {CPU_THREADS} threads, n_batch {GENERATION_CONFIG['n_batch']}")
+AUTOTUNE_AT_STARTUP = AUTOTUNE_MODE == "force" or (AUTOTUNE_MODE == "on" and tuning["source"] != "saved")
+
+MODEL_INSTANCES = resolve_model_instances(os.environ.get("MODEL_INSTANCES", "1"))
+# Tokens generated by the throwaway warmup request (0 skips it)
+WARMUP_TOKENS = int(os.environ.get("WARMUP_TOKENS", 8))
+WARMUP_PROMPT = "User: Hello\nAssistant:"
+WARMUP_RETRY_SECONDS = 5
+model_instances = []
+
+
+class ModelLoader:
+    """Loads and warms the model pool on a background thread so the web UI is up at once.
+
+    Readiness goes loading -> warming -> ready, or failed when no instance
+    could be loaded. Each instance joins the inference queue as soon as it is
+    warm, so questions are answered before the rest of the pool is done.
+    """
+
+    def __init__(self, instance_count):
+        self.instance_count = instance_count
+        self.state = "loading"
+        self.current_instance = 0
+        self.steps_done = 0
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._done = Event()
+        self.weights = None
+
+    def start(self):
+        Thread(target=self._run, name="model-loader", daemon=True).start()
+
+    def wait(self, timeout=None):
+        """Block until loading has finished, successfully or not."""
+        return self._done.wait(timeout)
+
+    @property
+    def serving(self):
+        """True once at least one instance can take questions."""
+        return bool(model_instances)
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def _run(self):
+        if MODEL_PREFETCH:
+            try:
+                self.weights = prefetch_model_file(model_file_path())
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Model prefetch skipped: {e}")
+        # Simple model loading exactly like server.py, once per pool instance
+        thread_shares = partition_threads(CPU_THREADS, self.instance_count)
+        for index in range(self.instance_count):
+            self.state, self.current_instance = "loading", index
+            n_threads = thread_shares[index]
+            try:
+                if WORKER_PROCESSES:
+                    instance = WorkerInstance(index, n_threads)
+                else:
+                    instance = ModelInstance(index, load_model(n_threads), n_threads)
+            except Exception as e:
+                print(f"❌ Model loading error: {e}")
+                print(f"📋 Please ensure '{MODEL_NAME}' is in your models folder")
+                self.error = str(e)
+                break
+            self.steps_done += 1
+            print(f"✅ Orca 2 7B Model Loaded Successfully! (instance {index + 1}/{self.instance_count}{', fake backend' if MODEL_BACKEND == 'fake' else ''}"
+                  f"{f', worker pid {instance.pid}' if WORKER_PROCESSES else ''})")
+            print(f"🧵 Using {n_threads} CPU threads for inference")
+
+            if index == 0 and AUTOTUNE_AT_STARTUP and WORKER_PROCESSES:
+                print("⚠️ Startup autotuning needs the model in-process; run `python zoho.py --autotune` once instead")
+            elif index == 0 and AUTOTUNE_AT_STARTUP and instance.supports_context_reuse:
+                self.state = "tuning"
+                try:
+                    calibrate(instance)
+                    thread_shares = partition_threads(CPU_THREADS, self.instance_count)
+                    instance.set_threads(thread_shares[0])
+                except Exception as e:
+                    print(f"⚠️ Autotune failed, keeping {n_threads} threads and n_batch {GENERATION_CONFIG['n_batch']}: {e}")
+
+            if BATCH_SEQUENCES > 1:
+                if isinstance(instance, ModelInstance) and instance.enable_batching(BATCH_SEQUENCES):
+                    print(f"🧮 Continuous batching: up to {BATCH_SEQUENCES} questions decode together on instance {index + 1}")
+                else:
+                    print("⚠️ Continuous batching needs an in-process backend with multi-sequence decoding; answering one question at a time per instance")
+            if DRAFT_MODEL_NAME and (instance.batch or not isinstance(instance, ModelInstance)):
+                print("⚠️ Speculative decoding needs an in-process instance without continuous batching, using plain generation")
+            elif DRAFT_MODEL_NAME and not instance.supports_speculation:
+                # Checked before loading the draft so it isn't loaded only to be thrown away
+                print("⚠️ This backend can't verify draft tokens in one pass, using plain generation")
+            elif DRAFT_MODEL_NAME:
+                try:
+                    draft = load_draft_model()
+                except Exception as e:
+                    print(f"⚠️ Draft model failed to load, using plain generation: {e}")
+                    draft = None
+                if draft is not None:
+                    instance.enable_speculation(draft)
+                    print(f"🎯 Speculative decoding: {DRAFT_MODEL_NAME} drafts {DRAFT_TOKENS} tokens per pass on instance {index + 1}")
+
+            self.state = "warming"
+            try:
+                instance.snapshot_prefix(SYSTEM_PROMPT)
+            except Exception as e:
+                print(f"⚠️ System prompt snapshot failed, evaluating it per request instead: {e}")
+            if instance.prefix_n_past:
+                print(f"📌 System prompt snapshotted ({instance.prefix_n_past} tokens, {instance.prefix_eval_seconds:.2f}s saved per request)")
+            try:
+                instance.warm_up(WARMUP_PROMPT, WARMUP_TOKENS)
+            except Exception as e:
+                print(f"⚠️ Warmup generation failed, the first question will be slower: {e}")
+            if instance.warmup_seconds:
+                print(f"🔥 Instance {index + 1} warmed up in {instance.warmup_seconds:.1f}s")
+            self.steps_done += 1
+            model_instances.append(instance)
+            inference_queue.add_instance(instance, instance.batch.max_sequences if instance.batch else 1)
+
+        self.state = "ready" if model_instances else "failed"
+        self.finished_at = time.time()
+        if model_instances:
+            print(f"🎯 Model ready: {len(model_instances)} instance(s) in {self.finished_at - self.started_at:.1f}s")
+        self._done.set()
+
+    def describe(self):
+        """One-line progress message for users waiting on startup."""
+        step = {"loading": "loading the model", "tuning": "calibrating CPU threads"}.get(self.state, "warming up the model")
+        if self.instance_count > 1:
+            step += f" {self.current_instance + 1}/{self.instance_count}"
+        return f"Zia Edge is still starting up ({step}, {self.status()['progress']:.0%} done). Please try again in a few seconds."
+
+    def status(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "state": self.state,
+            "progress": round(self.steps_done / (2 * self.instance_count), 2),
+            "instances_ready": len(model_instances),
+            "instances_total": self.instance_count,
+            "elapsed_seconds": round(elapsed, 1),
+            "error": self.error
+        }
+
+
+model_loader = ModelLoader(MODEL_INSTANCES)
+if WORKER_INDEX is None:
+    model_loader.start()
+    if WORKER_PROCESSES:
+        Thread(target=supervise_workers, name="worker-supervisor", daemon=True).start()
+
+# Response cache for repeated questions
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 512))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 3600))
+
+
+def normalize_message(message: str):
+    """Case- and whitespace-insensitive form of a question, ignoring trailing punctuation."""
+    return re.sub(r"\s+", " ", message.lower()).strip().rstrip("?!. ")
+
+
+class ResponseCache:
+    """Thread-safe LRU cache of finished answers with a time-to-live."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(user_message: str):
+        """Cache key: normalized question plus everything that shapes the answer."""
+        return (normalize_message(user_message), tuple(sorted(GENERATION_CONFIG.items())), MODEL_NAME, SYSTEM_PROMPT)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS)
+
+# Semantic cache: serve stored answers to paraphrased questions
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", 20000))
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.92))
+
+
+class SemanticCache:
+    """Cosine-similarity index over embeddings of previously answered questions.
+
+    Vectors live in one preallocated float32 matrix so a lookup is a single
+    matrix-vector product over every entry. When full, the least recently
+    used entry is overwritten; expired entries and entries produced under a
+    different generation config never match.
+    """
+
+    def __init__(self, embedder, capacity, threshold, ttl_seconds):
+        self.embedder = embedder
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self._lock = Lock()
+        self._embed_lock = Lock()
+        self._vectors = None
+        self._stored_at = np.zeros(capacity, dtype=np.float64)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._config_ids = np.full(capacity, -1, dtype=np.int32)
+        self._answers = [None] * capacity
+        self._config_index = {}
+        self._count = 0
+        self.hits = 0
+        self.misses = 0
+        self._lookup_seconds = 0.0
+
+    def embed(self, user_message: str):
+        """Unit-length embedding of the normalized question."""
+        with self._embed_lock:
+            vector = np.asarray(self.embedder.embed(normalize_message(user_message)), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, vector, config_key):
+        """Return (answer, similarity) for the closest live entry above the threshold."""
+        start_time = time.perf_counter()
+        with self._lock:
+            config_id = self._config_index.get(config_key)
+            answer = None
+            similarity = 0.0
+            if self._count and config_id is not None:
+                n = self._count
+                sims = self._vectors[:n] @ vector
+                now = time.time()
+                sims[(self._config_ids[:n] != config_id) | (now - self._stored_at[:n] > self.ttl_seconds)] = -1.0
+                best = int(np.argmax(sims))
+                similarity = float(sims[best])
+                if similarity >= self.threshold:
+                    self._last_used[best] = now
+                    answer = self._answers[best]
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self._lookup_seconds += time.perf_counter() - start_time
+        return answer, similarity
+
+    def put(self, vector, config_key, answer):
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+            config_id = self._config_index.setdefault(config_key, len(self._config_index))
+            if self._count < self.capacity:
+                slot = self._count
+                self._count += 1
+            else:
+                slot = int(np.argmin(self._last_used))
+            now = time.time()
+            self._vectors[slot] = vector
+            self._stored_at[slot] = now
+            self._last_used[slot] = now
+            self._config_ids[slot] = config_id
+            self._answers[slot] = answer
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._count,
+                "capacity": self.capacity,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "avg_lookup_ms": round(self._lookup_seconds * 1000 / lookups, 3) if lookups else 0.0
+            }
+
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED and WORKER_INDEX is None:
+    if np is None:
+        print("⚠️ Semantic cache disabled: numpy is not installed")
+    else:
+        try:
+            from gpt4all import Embed4All
+            semantic_cache = SemanticCache(Embed4All(), SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD, RESPONSE_CACHE_TTL_SECONDS)
+            print(f"🧠 Semantic cache enabled (threshold {SEMANTIC_CACHE_THRESHOLD})")
+        except Exception as e:
+            print(f"⚠️ Semantic cache disabled: {e}")
+
+
+def lookup_cached_answer(user_message, cache_key):
+    """Check the exact cache, then the semantic cache.
+
+    Returns the cached payload (or None) and the question embedding so a
+    freshly generated answer can be indexed without embedding twice.
+    """
+    cached = response_cache.get(cache_key)
+    if cached or semantic_cache is None:
+        return cached, None
+
+    vector = semantic_cache.embed(user_message)
+    answer, similarity = semantic_cache.lookup(vector, cache_key[1:])
+    if answer:
+        print(f"🧠 Semantic cache hit ({similarity:.2f}): {user_message}")
+        return dict(answer, similarity=round(similarity, 3)), vector
+    return None, vector
+
+
+def store_answer(user_message, cache_key, vector, payload):
+    """Remember a complete answer in every enabled cache."""
+    response_cache.put(cache_key, payload)
+    if semantic_cache is not None:
+        if vector is None:
+            vector = semantic_cache.embed(user_message)
+        semantic_cache.put(vector, cache_key[1:], payload)
+
+
+def wants_fresh_answer(data, headers=None):
+    """Clients skip the cache with {"fresh": true} or a Cache-Control: no-cache header."""
+    headers = request.headers if headers is None else headers
+    return bool(data.get('fresh')) or 'no-cache' in headers.get('Cache-Control', '')
+
+# Multi-turn chat sessions
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 500))
+SESSION_IDLE_SECONDS = int(os.environ.get("SESSION_IDLE_SECONDS", 1800))
+SESSION_TOKEN_BUDGET = int(os.environ.get("SESSION_TOKEN_BUDGET", 1024))
+
+
+def estimate_tokens(text: str):
+    """Rough token count (~4 characters per token) used for history budgeting."""
+    return len(text) // 4 + 1
+
+
+class ChatSession:
+    """Conversation state for one chat tab."""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.turns = []
+        self.last_used = time.time()
+        self.trimmed_turns = 0
+
+    @property
+    def context_key(self):
+        return (self.session_id, len(self.turns))
+
+    def history_tokens(self):
+        return sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns)
+
+    def add_turn(self, user_message, response):
+        """Record a finished turn, dropping the oldest ones beyond the token budget.
+
+        Returns True when older turns had to be trimmed.
+        """
+        self.turns.append((user_message, response))
+        trimmed = False
+        while len(self.turns) > 1 and self.history_tokens() > SESSION_TOKEN_BUDGET:
+            self.turns.pop(0)
+            self.trimmed_turns += 1
+            trimmed = True
+        return trimmed
+
+
+class SessionStore:
+    """Bounded LRU of chat sessions with idle eviction."""
+
+    def __init__(self, max_sessions, idle_seconds):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._sessions = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, session_id):
+        """Fetch or create the session; returns None for requests without a session id."""
+        if not session_id:
+            return None
+        session_id = str(session_id)[:64]
+        with self._lock:
+            self._evict_idle()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = ChatSession(session_id)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            return session
+
+    def _evict_idle(self):
+        cutoff = time.time() - self.idle_seconds
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if oldest.last_used >= cutoff:
+                break
+            self._sessions.popitem(last=False)
+
+    def prompt_for(self, session, instance, user_message, history=True):
+        """Prompt for the next turn and whether the model context must be reset.
+
+        When ``instance`` still holds this session's transcript from the
+        previous turn, only the new question is sent and the context is kept.
+        Otherwise earlier turns are replayed, unless ``history`` is False.
+        """
+        if session.turns and instance.context_key == session.context_key and instance.supports_context_reuse:
+            return f"\nUser: {user_message}\nAssistant:", False
+        return format_prompt(user_message, session.turns if history else ()), True
+
+    def stats(self):
+        with self._lock:
+            return {"active": len(self._sessions), "max_sessions": self.max_sessions, "idle_seconds": self.idle_seconds}
+
+
+session_store = SessionStore(MAX_SESSIONS, SESSION_IDLE_SECONDS)
+
+# Ensure static folder exists
+os.makedirs('static', exist_ok=True)
+
+def generate_qr_code(url):
+    """Generate QR code exactly like server.py"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+    
+    img = qr.make_image(fill_color="black", back_color="white")
+    
+    # Convert to base64 for embedding in HTML
+    buffered = io.BytesIO()   
+    img.save(buffered, format="PNG")
+    img_str = base64.b64encode(buffered.getvalue()).decode()
+    
+    return f"data:image/png;base64,{img_str}"
+
+# Generate QR code on startup
+QR_CODE = generate_qr_code(f"{SERVER_URL}/zia-chat")
+if WORKER_INDEX is None:
+    print(f"📍 Server URL: {SERVER_URL}")
+    print("📱 QR Code Generated - Scan with any phone camera!")
+
+
+def format_prompt(user_message: str, history=()):
+    """Simple prompt formatting for better responses, replaying earlier turns first"""
+    transcript = ''.join(f"User: {question}\nAssistant: {answer}\n" for question, answer in history)
+    return f"{transcript}User: {user_message}\nAssistant:"
+
+def clean_response(response: str):
+    """Strip whitespace and any echoed role prefix from a generated answer."""
+    response = response.strip()
+    if response.startswith('Assistant:'):
+        response = response[10:].strip()
+    return response
+
+def stream_model_inference(instance, prompt: str, stats: dict, reset_context=True, stop_reason=None, budget=None):
+    """Yield tokens as they are generated, applying the length cap, timeout and cancellation.
+
+    ``budget`` (from LoadGovernor.budget) overrides max_tokens and the
+    length cap; without it the configured limits apply.
+
+    ``stop_reason()`` returns "cancelled" or "deadline" once the generation
+    should end early. The backend is told to stop through its token callback
+    and drained before returning, so the instance is idle again when the
+    caller releases it. Timing and truncation details are written into
+    ``stats`` so callers that consume the stream incrementally can still
+    report them once it ends.
+    """
+    stats.update(duration=0.0, timed_out=False, truncated=False, cancelled=False, tokens=0, first_token=None,
+                 prefix_saved=instance.prefix_eval_seconds if instance.prefix_n_past else 0.0)
+    stop_reason = stop_reason or (lambda: None)
+    config = dict(GENERATION_CONFIG, max_tokens=budget["max_tokens"]) if budget else GENERATION_CONFIG
+    max_chars = budget["max_chars"] if budget else MAX_RESPONSE_CHARS
+    stop = Event()
+    char_count = 0
+    start_time = time.time()
+    tokens = instance.generate(prompt, reset_context=reset_context,
+                               callback=lambda token_id, response: not stop.is_set() and stop_reason() is None,
+                               **config)
+
+    try:
+        for token in tokens:
+            char_count += len(token)
+            stats["tokens"] += 1
+            if stats["first_token"] is None:
+                stats["first_token"] = time.time() - start_time
+            yield token
+
+            if char_count >= max_chars:
+                stats["truncated"] = True
+                print("✂️ Response length cap reached, truncating output.")
+                break
+
+            if (time.time() - start_time) >= GENERATION_TIMEOUT_SECONDS:
+                stats["timed_out"] = True
+                print("⏳ Generation timeout hit, cutting response early.")
+                break
+
+            if stop_reason():
+                break
+
+        # Also covers the backend ending early because the callback refused a token
+        reason = stop_reason()
+        if reason == "cancelled":
+            stats["cancelled"] = True
+            print("🛑 Everyone waiting for this answer left, stopping generation.")
+        elif reason == "deadline" and not stats["truncated"]:
+            stats["timed_out"] = True
+            print("⏳ Request deadline reached, cutting response early.")
+    finally:
+        stop.set()
+        try:
+            # The backend notices the stop at its next token; wait for that before handing the instance on
+            for _ in tokens:
+                pass
+        except Exception:
+            pass
+        stats["duration"] = time.time() - start_time
+
+class Flight:
+    """One in-progress generation that any number of identical requests follow.
+
+    Tokens are kept as they arrive so a request that attaches late still
+    replays the answer from the start before following it live. The flight
+    counts the requests following it and runs until the latest of their
+    deadlines; once every follower has left it is cancelled.
+    """
+
+    def __init__(self, key, ticket, user_message, vector, session=None, deadline=None):
+        self.key = key
+        self.ticket = ticket
+        self.user_message = user_message
+        self.vector = vector
+        self.session = session
+        self.deadline = deadline
+        self.followers = 1
+        self.cancelled = Event()
+        self.reused_context = False
+        # The granted answer budget, set before the first token so early leavers can report it
+        self.degradation = None
+        self.tokens = []
+        self.stats = {}
+        self.done = False
+        self.error = None
+        self.busy = False
+        self._callbacks = []
+        self._watchers = []
+        self._cond = Condition()
+
+    def extend_deadline(self, deadline):
+        """A new follower keeps the generation alive until its own deadline too."""
+        if self.deadline is not None:
+            self.deadline = None if deadline is None else max(self.deadline, deadline)
+
+    def stop_reason(self):
+        """"cancelled" or "deadline" once the generation should stop early, else None."""
+        if self.cancelled.is_set():
+            return "cancelled"
+        if self.deadline is not None and time.time() >= self.deadline:
+            return "deadline"
+        return None
+
+    def publish(self, token):
+        with self._cond:
+            self.tokens.append(token)
+            self._cond.notify_all()
+            watchers = list(self._watchers)
+        for watcher in watchers:
+            watcher()
+
+    def finish(self, error=None, busy=False):
+        """Mark the flight finished; ``busy`` is the rejection reason when it never reached the model."""
+        with self._cond:
+            self.error = error
+            self.busy = busy
+            self.done = True
+            self._cond.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+            watchers = list(self._watchers)
+        for watcher in watchers:
+            watcher()
+        for callback in callbacks:
+            callback(self)
+
+    def watch(self, watcher):
+        """Call ``watcher()`` after every new token and once the flight finishes.
+
+        Returns a function that stops the calls. They come from the generating
+        thread, so a watcher must only hand the news on, never block.
+        """
+        with self._cond:
+            self._watchers.append(watcher)
+
+        def unwatch():
+            with self._cond:
+                if watcher in self._watchers:
+                    self._watchers.remove(watcher)
+        return unwatch
+
+    def add_done_callback(self, callback):
+        """Call ``callback(flight)`` once the flight finishes (immediately if it already has)."""
+        with self._cond:
+            if not self.done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        """Block until the flight finishes or ``timeout`` passes; returns whether it finished."""
+        with self._cond:
+            if not self.done:
+                self._cond.wait_for(lambda: self.done, timeout)
+            return self.done
+
+    def events(self, poll_interval=1.0):
+        """Yield ("token", text) as tokens arrive and ("waiting", None) while idle."""
+        index = 0
+        while True:
+            with self._cond:
+                if index >= len(self.tokens) and not self.done:
+                    self._cond.wait(poll_interval)
+                new_tokens = self.tokens[index:]
+                index += len(new_tokens)
+                done = self.done
+            if not new_tokens and not done:
+                yield "waiting", None
+            for token in new_tokens:
+                yield "token", token
+            if done:
+                return
+
+    async def events_async(self, poll_interval=1.0):
+        """events() for coroutines: sleeps on the event loop until the flight has news."""
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        unwatch = self.watch(lambda: wake_soon(loop, changed))
+        index = 0
+        try:
+            while True:
+                changed.clear()
+                with self._cond:
+                    new_tokens = self.tokens[index:]
+                    index += len(new_tokens)
+                    done = self.done
+                if not new_tokens and not done:
+                    try:
+                        await asyncio.wait_for(changed.wait(), poll_interval)
+                    except asyncio.TimeoutError:
+                        yield "waiting", None
+                    continue
+                for token in new_tokens:
+                    yield "token", token
+                if done:
+                    return
+        finally:
+            unwatch()
+
+    @property
+    def response(self):
+        return clean_response(''.join(self.tokens))
+
+
+def wake_soon(loop, event):
+    """Set an asyncio ``event`` from any thread; a loop that has shut down is ignored."""
+    try:
+        loop.call_soon_threadsafe(event.set)
+    except RuntimeError:
+        pass
+
+
+class SingleFlight:
+    """Coalesces concurrent identical questions onto one queued generation.
+
+    Nothing runs for a flight while it waits in the queue: its generation is
+    handed to a pool with one thread per queue slot when the ticket is
+    granted, and a single sweeper withdraws waiting flights that were
+    cancelled, ran out of time or waited longer than QUEUE_WAIT_TIMEOUT_SECONDS.
+    """
+
+    def __init__(self, max_workers):
+        self._flights = {}
+        self._waiting = set()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="generate")
+        self._sweeper = None
+        self.coalesced = 0
+
+    def join(self, key, user_message, vector=None, session=None, background=False, deadline=None,
+             client=None, priority=DEFAULT_PRIORITY):
+        """Attach to the running generation for ``key`` or start a new one.
+
+        The first request's ``session`` owns the generation: its history shapes
+        the prompt and the finished turn is recorded there. ``client`` and
+        ``priority`` place the generation in the queue; a request joining a
+        waiting generation from a lower lane lifts it up to its own. ``deadline`` (absolute time, None for no limit) bounds queue wait
+        plus generation. Every join must be matched by a ``leave``. Returns
+        (flight, leader); raises QueueFullError when a new generation cannot
+        be admitted.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight:
+                self.coalesced += 1
+                flight.followers += 1
+                flight.extend_deadline(deadline)
+                if not background:
+                    inference_queue.promote(flight.ticket, priority, client)
+                return flight, False
+            flight = Flight(key, None, user_message, vector, session, deadline)
+            # A ticket granted straight away starts _run at once, which waits for this lock
+            flight.ticket = inference_queue.submit(affinity=session.session_id if session else None, background=background,
+                                                   client=client, priority=priority,
+                                                   on_grant=lambda ticket: self._executor.submit(self._run, flight))
+            self._flights[key] = flight
+            self._waiting.add(flight)
+            if self._sweeper is None:
+                self._sweeper = Thread(target=self._sweep_waiting, daemon=True)
+                self._sweeper.start()
+        return flight, True
+
+    def leave(self, flight, reason):
+        """Stop following ``flight``; the last follower out stops it if it is still running.
+
+        A stopped flight leaves the queue or ends at its next token, so the
+        model goes straight to the next waiting request. When the last
+        follower's deadline ran out the flight ends as a normal timeout,
+        keeping its partial answer; otherwise it is cancelled outright.
+        """
+        with self._lock:
+            flight.followers -= 1
+            if flight.followers > 0 or flight.done or flight.cancelled.is_set():
+                return
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            if reason == "deadline":
+                flight.deadline = time.time()
+            else:
+                flight.cancelled.set()
+        CANCELLATIONS.inc(reason=reason)
+
+    def _sweep_waiting(self):
+        """Take abandoned flights out of the queue so they stop holding a place in line."""
+        while True:
+            time.sleep(CANCEL_POLL_SECONDS)
+            with self._lock:
+                waiting = list(self._waiting)
+            for flight in waiting:
+                reason = flight.stop_reason()
+                # Batch work waits as long as it takes behind interactive traffic
+                if not reason and (flight.ticket.background or flight.ticket.wait_time < QUEUE_WAIT_TIMEOUT_SECONDS):
+                    continue
+                if not inference_queue.cancel(flight.ticket):
+                    # Granted meanwhile; the generation notices the stop at its first token
+                    continue
+                if reason == "cancelled":
+                    flight.finish("Request cancelled before the AI model was free.")
+                elif reason == "deadline":
+                    flight.finish("The request deadline passed while waiting for the AI model. Please try again.", busy="deadline")
+                else:
+                    flight.finish("Timed out waiting for the AI model. Please try again.", busy="queue_timeout")
+                with self._lock:
+                    self._waiting.discard(flight)
+                    if self._flights.get(flight.key) is flight:
+                        del self._flights[flight.key]
+
+    def _run(self, flight):
+        with self._lock:
+            self._waiting.discard(flight)
+        try:
+            instance = flight.ticket.instance
+            try:
+                # Batch work only runs when no one is waiting, so it keeps the full budget
+                budget = load_governor.budget(adaptive=not flight.ticket.background)
+                flight.degradation = {key: budget[key] for key in ("level", "name", "max_tokens")}
+                if flight.session:
+                    prompt, reset_context = session_store.prompt_for(flight.session, instance, flight.user_message, budget["history"])
+                else:
+                    prompt, reset_context = format_prompt(flight.user_message), True
+                flight.reused_context = not reset_context
+
+                for token in stream_model_inference(instance, prompt, flight.stats, reset_context, flight.stop_reason, budget):
+                    flight.publish(token)
+                # Cut short by the reduced budget rather than finishing on its own
+                flight.stats["budget_limited"] = budget["level"] > 0 and (
+                    flight.stats["tokens"] >= budget["max_tokens"] or flight.stats["truncated"])
+
+                if flight.stats["cancelled"]:
+                    # The context holds a half-finished turn nobody will continue
+                    instance.context_key = None
+                elif flight.session:
+                    # Claim the context before the instance can be handed to anyone else
+                    trimmed = flight.session.add_turn(flight.user_message, flight.response)
+                    complete = not (flight.stats["timed_out"] or flight.stats["truncated"])
+                    instance.context_key = flight.session.context_key if complete and not trimmed else None
+            finally:
+                inference_queue.release(flight.ticket)
+
+            record_generation_metrics(flight)
+            if flight.ticket.priority == PRIORITY_CLASSES[-1]:
+                rate_limiter.charge(flight.ticket.client, flight.stats["tokens"])
+            response = flight.response
+            if flight.stats["cancelled"]:
+                print(f"🛑 Generation cancelled after {flight.stats['tokens']} tokens, model freed for the next question")
+            elif response and not flight.stats["timed_out"] and not flight.stats["budget_limited"] and is_cacheable(flight.key):
+                store_answer(flight.user_message, flight.key, flight.vector, {"success": True, "response": response, "timed_out": False})
+            flight.finish()
+        except Exception as e:
+            print(f"❌ Generation error: {e}")
+            ERRORS.inc(endpoint="generation")
+            flight.finish(str(e))
+        finally:
+            # Only forget the flight once its answer is cached, so no request slips between the two
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+
+
+single_flight = SingleFlight(MODEL_INSTANCES * BATCH_SEQUENCES)
+
+register(Gauge("zia_queue_depth", "Requests waiting for a model instance.",
+               lambda: {(("lane", lane),): inference_queue.stats()[lane] for lane in ("waiting", "background")}))
+register(Gauge("zia_queue_waiting_by_priority", "Interactive requests waiting, by priority class.",
+               lambda: {(("priority", priority),): waiting for priority, waiting in inference_queue.stats()["waiting_by_class"].items()}))
+register(Gauge("zia_model_busy", "Model instances currently generating.", lambda: inference_queue.stats()["active"]))
+register(Gauge("zia_model_instances", "Model instances loaded.", lambda: len(model_instances)))
+register(Gauge("zia_batch_active_sequences", "Sequences decoding together, by instance (continuous batching).",
+               lambda: {(("instance", str(i.index)),): i.batch.active for i in model_instances if i.batch}))
+register(Gauge("zia_batch_steps_total", "Batched decoding steps, by instance.",
+               lambda: {(("instance", str(i.index)),): i.batch.steps for i in model_instances if i.batch}, kind="counter"))
+register(Gauge("zia_batch_tokens_total", "Tokens decoded in batched steps, by instance.",
+               lambda: {(("instance", str(i.index)),): i.batch.tokens for i in model_instances if i.batch}, kind="counter"))
+register(Gauge("zia_speculative_draft_tokens_total", "Tokens proposed by the draft model, by instance.",
+               lambda: {(("instance", str(i.index)),): i.speculative.proposed for i in model_instances if i.speculative}, kind="counter"))
+register(Gauge("zia_speculative_accepted_tokens_total", "Draft tokens the main model accepted, by instance.",
+               lambda: {(("instance", str(i.index)),): i.speculative.accepted for i in model_instances if i.speculative}, kind="counter"))
+register(Gauge("zia_speculative_acceptance_rate", "Share of draft tokens accepted, by instance.",
+               lambda: {(("instance", str(i.index)),): round(i.speculative.acceptance_rate, 4) for i in model_instances if i.speculative}))
+register(Gauge("zia_model_ready", "1 once the model pool is loaded and warmed.", lambda: int(model_loader.ready)))
+register(Gauge("zia_degradation_level", "Current answer-budget degradation level (0 = full length).", lambda: load_governor.level))
+register(Gauge("zia_cache_hits_total", "Answers served from a cache.", lambda: {
+    (("cache", "exact"),): response_cache.hits,
+    (("cache", "semantic"),): semantic_cache.hits if semantic_cache else 0,
+}, kind="counter"))
+register(Gauge("zia_cache_misses_total", "Cache lookups that found no answer.", lambda: {
+    (("cache", "exact"),): response_cache.misses,
+    (("cache", "semantic"),): semantic_cache.misses if semantic_cache else 0,
+}, kind="counter"))
+register(Gauge("zia_coalesced_requests_total", "Requests that joined an identical in-flight generation.",
+               lambda: single_flight.coalesced, kind="counter"))
+
+
+def record_generation_metrics(flight):
+    """Observe one finished generation (once, however many requests followed it)."""
+    stats = flight.stats
+    QUEUE_WAIT_SECONDS.observe(flight.ticket.wait_time, priority=flight.ticket.priority)
+    load_governor.observe(flight.ticket.wait_time)
+    GENERATION_SECONDS.observe(stats["duration"])
+    if stats.get("first_token") is not None:
+        TIME_TO_FIRST_TOKEN_SECONDS.observe(flight.ticket.wait_time + stats["first_token"])
+    if stats["duration"] > 0 and stats["tokens"]:
+        TOKENS_PER_SECOND.observe(stats["tokens"] / stats["duration"])
+    if stats["timed_out"]:
+        GENERATION_TIMEOUTS.inc()
+    if stats["truncated"]:
+        LENGTH_TRUNCATIONS.inc()
+
+
+def request_key(user_message, session):
+    """Flight/cache key: follow-up turns depend on history, so they never share answers."""
+    if session and session.turns:
+        return ("session", session.session_id, len(session.turns), normalize_message(user_message))
+    return response_cache.key(user_message)
+
+
+def is_cacheable(key):
+    return key[0] != "session"
+
+
+def record_follower_turn(session, flight_session, user_message, response):
+    """Sessions that got their answer from a cache or another request's generation."""
+    if session and session is not flight_session:
+        session.add_turn(user_message, response)
+
+
+# Bulk question answering
+MAX_BATCH_QUESTIONS = int(os.environ.get("MAX_BATCH_QUESTIONS", 500))
+
+
+def run_batch(questions, fresh=False):
+    """Answer a list of questions as one background job.
 
-# Ensure static folder exists
-os.makedirs('static', exist_ok=True)
+    Keeps at most one generation per queue slot in flight and yields a
+    result dict per question as soon as it completes (not in input order),
+    followed by a summary with aggregate tokens/sec. Closing the generator
+    early (the client went away) cancels whatever is still in flight.
+    """
+    start_time = time.time()
+    completed = Queue()
+    pending = list(enumerate(questions))
+    pending.reverse()
+    following = []
+    total_tokens = 0
+    answered = 0
+    window = max(1, inference_queue.slots)
 
-def generate_qr_code(url):
-    """Generate QR code exactly like server.py"""
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(url)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Convert to base64 for embedding in HTML
-    buffered = io.BytesIO()   
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    
-    return f"data:image/png;base64,{img_str}"
+    try:
+        while pending or following:
+            while pending and len(following) < window:
+                index, question = pending.pop()
+                question = str(question).strip()
+                if not question:
+                    yield {"index": index, "question": question, "success": False, "error": "Empty message"}
+                    continue
 
-# Generate QR code on startup
-QR_CODE = generate_qr_code(f"{SERVER_URL}/zia-chat")
-print(f"📍 Server URL: {SERVER_URL}")
-print("📱 QR Code Generated - Scan with any phone camera!")
+                cache_key = response_cache.key(question)
+                cached, vector = (None, None) if fresh else lookup_cached_answer(question, cache_key)
+                if cached:
+                    answered += 1
+                    yield {"index": index, "question": question, "success": True, "response": cached["response"],
+                           "cached": True, "tokens": 0, "response_time": "0.0s"}
+                    continue
 
+                flight, _ = single_flight.join(cache_key, question, vector, background=True)
+                following.append(flight)
+                flight.add_done_callback(lambda f, index=index, question=question: completed.put((index, question, f)))
 
-def run_model_inference(prompt: str):
-    """Generate a response with timeout and length guards to keep POST fast."""
-    if not model_loaded or not model:
-        return "", 0.0, False, "Model is not loaded."
+            if not following:
+                continue
+            index, question, flight = completed.get()
+            following.remove(flight)
+            single_flight.leave(flight, "done")
+            if flight.error:
+                yield {"index": index, "question": question, "success": False, "error": flight.error}
+                continue
 
-    tokens = []
-    char_count = 0
-    timed_out = False
-    start_time = time.time()
+            answered += 1
+            total_tokens += flight.stats["tokens"]
+            # A question that joined an interactive generation shares its (possibly reduced) budget
+            budget_limited = flight.stats.get("budget_limited", False)
+            yield {"index": index, "question": question, "success": True, "response": flight.response,
+                   "cached": False, "tokens": flight.stats["tokens"], "timed_out": flight.stats["timed_out"],
+                   "response_time": f"{flight.stats['duration']:.1f}s", "degradation": flight.degradation,
+                   "budget_limited": budget_limited, "notice": BUSY_SHORTENED_NOTICE if budget_limited else None}
+    finally:
+        for flight in following:
+            single_flight.leave(flight, "client_gone")
 
-    for token in model.generate(prompt, streaming=True, **GENERATION_CONFIG):
-        tokens.append(token)
-        char_count += len(token)
+    elapsed = time.time() - start_time
+    yield {
+        "done": True,
+        "questions": len(questions),
+        "answered": answered,
+        "generated_tokens": total_tokens,
+        "elapsed": f"{elapsed:.1f}s",
+        "tokens_per_second": round(total_tokens / elapsed, 2) if elapsed > 0 else 0.0
+    }
 
-        if char_count >= MAX_RESPONSE_CHARS:
-            print("✂️ Response length cap reached, truncating output.")
-            break
+def sse_event(event: str, payload: dict):
+    """Format one Server-Sent Events frame with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
 
-        if (time.time() - start_time) >= GENERATION_TIMEOUT_SECONDS:
-            timed_out = True
-            print("⏳ Generation timeout hit, cutting response early.")
-            break
+# Third-party assets are vendored under static/vendor/<name>-<version>/ so the pages
+# render with no internet; a new version means a new path, so they cache forever
+VENDOR_PREFIX = '/static/vendor/'
+FONT_AWESOME_DIR = VENDOR_PREFIX + 'fontawesome-6.4.0'
+INTER_DIR = VENDOR_PREFIX + 'inter-4.001'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 
-    response = ''.join(tokens).strip()
-    duration = time.time() - start_time
+def pwa_head_tags():
+    """Manifest, icons and service worker registration shared by both pages"""
+    return '''
+    <link rel="manifest" href="/manifest.json">
+    <meta name="theme-color" content="#E41E26">
+    <link rel="icon" type="image/png" sizes="192x192" href="/static/icons/icon-192.png">
+    <link rel="apple-touch-icon" href="/static/icons/icon-192.png">
+    <script>
+        if ('serviceWorker' in navigator) {
+            window.addEventListener('load', () => navigator.serviceWorker.register('/sw.js').catch(() => {}));
+        }
+    </script>'''
 
-    if not response:
-        response = ""
+def icon_stylesheet_tags():
+    """Local Font Awesome (solid set only) instead of the CDN"""
+    return f'''
+    <link rel="preload" href="{FONT_AWESOME_DIR}/webfonts/fa-solid-900.woff2" as="font" type="font/woff2" crossorigin>
+    <link rel="stylesheet" href="{FONT_AWESOME_DIR}/css/fontawesome.min.css">
+    <link rel="stylesheet" href="{FONT_AWESOME_DIR}/css/solid.min.css">'''
 
-    return response, duration, timed_out, None
+def text_font_tags():
+    """Local Inter (the weights the pages use) instead of Google Fonts"""
+    return f'''
+    <link rel="preload" href="{INTER_DIR}/webfonts/Inter-Regular.woff2" as="font" type="font/woff2" crossorigin>
+    <link rel="stylesheet" href="{INTER_DIR}/css/inter.css">'''
 
-@app.route('/')
-def home():
+def render_home_page():
     """Home page with QR code"""
     return f'''
     <!DOCTYPE html>
@@ -131,7 +2694,7 @@ def home():
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>Zia Edge - Enterprise Offline AI</title>
-        <link href="https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700;800&display=swap" rel="stylesheet">
+{pwa_head_tags()}{text_font_tags()}
         <style>
             :root {{
                 --zoho-red: #E41E26;
@@ -318,8 +2881,7 @@ def home():
     </html>
     '''
 
-@app.route('/zia-chat')
-def zia_chat():
+def render_chat_page():
     """Production-ready chat interface with loading screen like EduMate"""
     return '''
 <!DOCTYPE html>
@@ -328,7 +2890,7 @@ def zia_chat():
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Zia Edge - Enterprise AI Assistant</title>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
+''' + pwa_head_tags() + icon_stylesheet_tags() + '''
     <style>
         * {
             margin: 0;
@@ -357,7 +2919,7 @@ def zia_chat():
             justify-content: center;
             align-items: center;
             z-index: 9999;
-            transition: opacity 0.8s ease-out;
+            transition: opacity 0.3s ease-out;
         }
 
         .logo-container {
@@ -407,22 +2969,6 @@ def zia_chat():
             animation: gradient 3s linear infinite;
         }
 
-        .progress-container {
-            width: 300px;
-            height: 6px;
-            background: rgba(255, 255, 255, 0.1);
-            border-radius: 10px;
-            overflow: hidden;
-        }
-
-        .progress-bar {
-            height: 100%;
-            width: 0%;
-            background: linear-gradient(to right, #E41E26, #FF6B00);
-            border-radius: 10px;
-            transition: width 2s ease-in-out;
-        }
-
         .loading-subtext {
             margin-top: 20px;
             font-size: 14px;
@@ -656,6 +3202,12 @@ def zia_chat():
             animation: typingAnimation 1.4s infinite ease-in-out;
         }
 
+        .queue-status {
+            margin-left: 12px;
+            font-size: 13px;
+            opacity: 0.7;
+        }
+
         .typing-dot:nth-child(1) { animation-delay: 0s; }
         .typing-dot:nth-child(2) { animation-delay: 0.2s; }
         .typing-dot:nth-child(3) { animation-delay: 0.4s; }
@@ -732,9 +3284,6 @@ def zia_chat():
             </div>
         </div>
         <div class="loading-text">Zia Edge</div>
-        <div class="progress-container">
-            <div class="progress-bar" id="progress-bar"></div>
-        </div>
         <div class="loading-subtext">Initializing enterprise AI assistant...</div>
     </div>
 
@@ -788,6 +3337,7 @@ def zia_chat():
                         <div class="typing-dot"></div>
                         <div class="typing-dot"></div>
                     </div>
+                    <span class="queue-status" id="queue-status"></span>
                 </div>
                 
                 <div class="input-container">
@@ -803,35 +3353,41 @@ def zia_chat():
     <script>
         // Global variables
         let isProcessing = false;
+        
+        // Server-side conversation memory is keyed by this id; New Chat starts a fresh one
+        function newSessionId() {
+            return (window.crypto && crypto.randomUUID) ? crypto.randomUUID() :
+                Date.now().toString(36) + Math.random().toString(36).slice(2);
+        }
+        let sessionId = sessionStorage.getItem('zia-session') || newSessionId();
+        sessionStorage.setItem('zia-session', sessionId);
+
+        // Teachers open the page once as /?token=...; the token is kept and dropped from the address bar
+        const tokenParam = new URLSearchParams(location.search).get('token');
+        if (tokenParam !== null) {
+            localStorage.setItem('zia-token', tokenParam);
+            history.replaceState(null, '', location.pathname);
+        }
+        const askHeaders = {'Content-Type': 'application/json'};
+        if (localStorage.getItem('zia-token')) {
+            askHeaders['X-Zia-Token'] = localStorage.getItem('zia-token');
+        }
 
         document.addEventListener('DOMContentLoaded', function() {
             const loadingScreen = document.getElementById('loading-screen');
             const chatInterface = document.getElementById('chat-interface');
-            const progressBar = document.getElementById('progress-bar');
             const messageInput = document.getElementById('message-input');
             const sendButton = document.getElementById('send-button');
             const messagesContainer = document.getElementById('messages-container');
             const typingIndicator = document.getElementById('typing-indicator');
+            const queueStatus = document.getElementById('queue-status');
             const newChatBtn = document.getElementById('new-chat-btn');
             const themeToggle = document.getElementById('theme-toggle');
 
-            // Simulate loading progress
-            let progress = 0;
-            const interval = setInterval(() => {
-                progress += 2;
-                progressBar.style.width = `${progress}%`;
-                
-                if (progress >= 100) {
-                    clearInterval(interval);
-                    
-                    loadingScreen.style.opacity = '0';
-                    
-                    setTimeout(() => {
-                        loadingScreen.style.display = 'none';
-                        chatInterface.style.display = 'flex';
-                    }, 800);
-                }
-            }, 40);
+            // Everything the chat needs is already on the page: show it straight away
+            chatInterface.style.display = 'flex';
+            loadingScreen.style.opacity = '0';
+            setTimeout(() => { loadingScreen.style.display = 'none'; }, 300);
             
             // Auto-resize textarea
             messageInput.addEventListener('input', function() {
@@ -855,41 +3411,197 @@ def zia_chat():
                     messagesContainer.scrollTop = messagesContainer.scrollHeight;
                     
                     isProcessing = true;
+                    sendButton.innerHTML = '<i class="fas fa-stop"></i>';
+                    const answer = answerRenderer();
                     
                     try {
-                        // Send message to backend
-                        const response = await fetch('/ask', {
-                            method: 'POST',
-                            headers: {'Content-Type': 'application/json'},
-                            body: JSON.stringify({message: message})
-                        });
-                        
-                        if (!response.ok) {
-                            throw new Error(`HTTP error! status: ${response.status}`);
-                        }
-                        
-                        const data = await response.json();
-                        
-                        // Hide typing indicator
-                        typingIndicator.style.display = 'none';
-                        
-                        // Add AI response to UI
-                        if (data.success && data.response) {
-                            addMessage(data.response, 'ai');
+                        // Stream the answer token-by-token, over the open socket when there is one
+                        const ws = await openChatSocket();
+                        if (ws) {
+                            await askOverSocket(ws, message, answer);
                         } else {
-                            addMessage("Sorry, I'm having trouble processing your request. Please try again.", 'ai');
+                            await askOverHttp(message, answer);
                         }
+                        answer.finish();
                         
                     } catch (error) {
-                        console.error('Error communicating with backend:', error);
-                        typingIndicator.style.display = 'none';
-                        addMessage("Sorry, I'm having trouble connecting to the server. Please make sure the backend is running.", 'ai');
+                        if (error.name === 'AbortError') {
+                            answer.handle('cancelled', {});
+                            answer.finish();
+                        } else {
+                            console.error('Error communicating with backend:', error);
+                            typingIndicator.style.display = 'none';
+                            addMessage("Sorry, I'm having trouble connecting to the server. Please make sure the backend is running.", 'ai');
+                        }
                     } finally {
                         isProcessing = false;
+                        stopAnswer = null;
+                        sendButton.innerHTML = '<i class="fas fa-paper-plane"></i>';
+                    }
+                }
+            }
+            
+            // Stops the answer being streamed; set by whichever transport is carrying it
+            let stopAnswer = null;
+            
+            // Persistent chat channel: Socket.IO over a bare WebSocket (Engine.IO v4 packets:
+            // 0 open, 2 ping, 3 pong, 40 connect, 42 event). Falls back to /ask/stream when unavailable.
+            const chatSocket = {enabled: ''' + json.dumps(WEBSOCKET_CHAT) + ''' && 'WebSocket' in window, opening: null, pending: {}, nextId: 0};
+            
+            function openChatSocket() {
+                if (!chatSocket.enabled) return Promise.resolve(null);
+                if (chatSocket.opening) return chatSocket.opening;
+                chatSocket.opening = new Promise(resolve => {
+                    const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+                    const ws = new WebSocket(`${scheme}://${location.host}/socket.io/?EIO=4&transport=websocket`);
+                    let connected = false;
+                    const giveUp = setTimeout(() => ws.close(), 5000);
+                    ws.onmessage = (e) => {
+                        const packet = e.data;
+                        if (packet[0] === '0') {
+                            ws.send('40' + JSON.stringify({token: localStorage.getItem('zia-token') || ''}));
+                        } else if (packet === '2') {
+                            ws.send('3');
+                        } else if (packet.startsWith('40')) {
+                            connected = true;
+                            clearTimeout(giveUp);
+                            resolve(ws);
+                        } else if (packet.startsWith('42')) {
+                            const [event, data] = JSON.parse(packet.slice(2));
+                            const handler = chatSocket.pending[data.id];
+                            if (handler) handler(event, data);
+                        } else if (packet.startsWith('44')) {
+                            ws.close();
+                        }
+                    };
+                    ws.onclose = () => {
+                        clearTimeout(giveUp);
+                        chatSocket.opening = null;
+                        if (!connected) {
+                            // No socket support here: stay on HTTP streaming
+                            chatSocket.enabled = false;
+                            resolve(null);
+                        }
+                        // Answers still arriving on a dropped socket end with an error; the next question reconnects
+                        Object.values(chatSocket.pending).forEach(handler => handler('error', {error: 'Connection lost. Please ask again.'}));
+                        chatSocket.pending = {};
+                    };
+                });
+                return chatSocket.opening;
+            }
+            
+            function askOverSocket(ws, message, answer) {
+                const id = String(++chatSocket.nextId);
+                return new Promise(resolve => {
+                    chatSocket.pending[id] = (event, data) => {
+                        if (answer.handle(event, data)) {
+                            delete chatSocket.pending[id];
+                            resolve();
+                        }
+                    };
+                    stopAnswer = () => ws.send('42' + JSON.stringify(['cancel', {id: id}]));
+                    ws.send('42' + JSON.stringify(['ask', {id: id, message: message, session_id: sessionId}]));
+                });
+            }
+            
+            async function askOverHttp(message, answer) {
+                const controller = new AbortController();
+                stopAnswer = () => controller.abort();
+                const response = await fetch('/ask/stream', {
+                    method: 'POST',
+                    headers: askHeaders,
+                    body: JSON.stringify({message: message, session_id: sessionId}),
+                    signal: controller.signal
+                });
+                
+                const contentType = response.headers.get('Content-Type') || '';
+                if (!contentType.includes('text/event-stream')) {
+                    // Server refused before streaming (empty message, model not loaded, queue full...)
+                    if (!contentType.includes('application/json')) {
+                        throw new Error(`HTTP error! status: ${response.status}`);
+                    }
+                    answer.handle('error', await response.json());
+                    return;
+                }
+                
+                await readStream(response, answer);
+            }
+            
+            // Consume Server-Sent Events from /ask/stream
+            async function readStream(response, answer) {
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let finished = false;
+                
+                while (!finished) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    
+                    let boundary;
+                    while (!finished && (boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                        const frame = buffer.slice(0, boundary);
+                        buffer = buffer.slice(boundary + 2);
+                        
+                        let event = 'message';
+                        let dataLine = '';
+                        frame.split('\\n').forEach(line => {
+                            if (line.startsWith('event: ')) event = line.slice(7);
+                            else if (line.startsWith('data: ')) dataLine += line.slice(6);
+                        });
+                        if (!dataLine) continue;
+                        finished = answer.handle(event, JSON.parse(dataLine));
                     }
                 }
             }
             
+            // Renders one answer's events as they arrive; handle() returns true on the final event
+            function answerRenderer() {
+                let contentEl = null;
+                
+                const ensureMessage = () => {
+                    if (!contentEl) {
+                        typingIndicator.style.display = 'none';
+                        queueStatus.textContent = '';
+                        contentEl = addMessage('', 'ai');
+                    }
+                    return contentEl;
+                };
+                
+                return {
+                    handle(event, data) {
+                        if (event === 'queue') {
+                            queueStatus.textContent = data.position > 0 ? `You are #${data.position} in line...` : '';
+                        } else if (event === 'token') {
+                            ensureMessage().textContent += data.token;
+                            messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                        } else if (event === 'done') {
+                            const el = ensureMessage();
+                            el.textContent = data.response || '';
+                            if (data.notice) el.textContent += (data.response ? '\\n\\n' : '') + data.notice;
+                            return true;
+                        } else if (event === 'error') {
+                            ensureMessage().textContent = data.error ? `Sorry: ${data.error}` : "Sorry, I'm having trouble processing your request. Please try again.";
+                            return true;
+                        } else if (event === 'cancelled') {
+                            const el = ensureMessage();
+                            el.textContent += el.textContent ? ' [stopped]' : 'Stopped.';
+                            return true;
+                        }
+                        return false;
+                    },
+                    finish() {
+                        if (!contentEl) {
+                            typingIndicator.style.display = 'none';
+                            addMessage("Sorry, I'm having trouble processing your request. Please try again.", 'ai');
+                        }
+                        queueStatus.textContent = '';
+                        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                    }
+                };
+            }
+            
             // Add message to chat
             function addMessage(content, type) {
                 const messageEl = document.createElement('div');
@@ -911,10 +3623,18 @@ def zia_chat():
                 
                 // Scroll to bottom
                 messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                
+                return messageContent;
             }
             
             // Event listeners
-            sendButton.addEventListener('click', sendMessage);
+            sendButton.addEventListener('click', function() {
+                if (isProcessing) {
+                    if (stopAnswer) stopAnswer();
+                } else {
+                    sendMessage();
+                }
+            });
             
             messageInput.addEventListener('keydown', function(e) {
                 if (e.key === 'Enter' && !e.shiftKey) {
@@ -925,6 +3645,8 @@ def zia_chat():
             
             // New chat button
             newChatBtn.addEventListener('click', function() {
+                sessionId = newSessionId();
+                sessionStorage.setItem('zia-session', sessionId);
                 messagesContainer.innerHTML = '';
                 addMessage("Hello! I'm Zia Edge, your enterprise AI assistant powered by offline AI. How can I help you today?", 'ai');
             });
@@ -944,6 +3666,238 @@ def zia_chat():
 </html>
     '''
 
+
+class PrerenderedPage:
+    """HTML rendered once, kept with gzip/brotli variants and served with validators.
+
+    Repeat visitors revalidate with If-None-Match / If-Modified-Since and get a
+    bodyless 304, so page hits cost neither CPU nor hotspot bandwidth. Each
+    encoding is a different set of bytes, so each gets its own strong ETag.
+    """
+
+    def __init__(self, html):
+        self.body = html.encode('utf-8')
+        self.digest = hashlib.sha1(self.body).hexdigest()[:16]
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        self.variants = {'gzip': gzip.compress(self.body, 9)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(self.body, quality=11)
+
+    def etag(self, encoding):
+        """Strong ETag of the ``encoding`` variant (None for the plain body)."""
+        return f"{self.digest}-{encoding}" if encoding else self.digest
+
+    def serve(self):
+        accepted = request.accept_encodings
+        encoding = next((e for e in ('br', 'gzip') if e in self.variants and accepted[e]), None)
+        etag = self.etag(encoding)
+        # If-None-Match uses weak comparison, so W/"..." from a proxy still matches
+        if request.if_none_match.contains_weak(etag) or (
+                not request.if_none_match and request.if_modified_since
+                and request.if_modified_since >= self.last_modified):
+            response = Response(status=304)
+        else:
+            response = Response(self.variants[encoding] if encoding else self.body, mimetype='text/html')
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.last_modified = self.last_modified
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+
+HOME_PAGE = PrerenderedPage(render_home_page())
+CHAT_PAGE = PrerenderedPage(render_chat_page())
+
+@app.route('/')
+def home():
+    """Home page with QR code, rendered once at startup"""
+    return HOME_PAGE.serve()
+
+@app.route('/zia-chat')
+def zia_chat():
+    """Chat interface, rendered once at startup"""
+    return CHAT_PAGE.serve()
+
+BUSY_SHORTENED_NOTICE = "[Answer shortened because many people are asking right now. Ask again later for more detail.]"
+
+# Replies below are (status, payload, headers) so the Flask routes and the ASGI app share them
+
+def json_response(reply):
+    """Flask response for a (status, payload, headers) reply."""
+    status, payload, headers = reply
+    response = jsonify(payload)
+    response.status_code = status
+    response.headers.update(headers)
+    return response
+
+def busy_reply(error, retry_after, reason="queue_full", status=503, **details):
+    """503 reply telling the client the model is saturated and when to retry."""
+    REJECTIONS.inc(reason=reason)
+    return status, dict({"success": False, "error": error, "retry_after": retry_after}, **details), {'Retry-After': str(retry_after)}
+
+def busy_response(error, retry_after, reason="queue_full", status=503, **details):
+    return json_response(busy_reply(error, retry_after, reason, status, **details))
+
+def model_unavailable_reply():
+    """None once an instance can take questions, otherwise the reply explaining why not."""
+    if model_loader.serving:
+        return None
+    if model_loader.state == "failed":
+        return 200, {
+            "success": False,
+            "error": f"AI model failed to load ({model_loader.error}). Please check the model file."
+        }, {}
+    return busy_reply(model_loader.describe(), WARMUP_RETRY_SECONDS, reason="warming_up",
+                      warming_up=True, readiness=model_loader.status())
+
+def model_unavailable_response():
+    unavailable = model_unavailable_reply()
+    return unavailable and json_response(unavailable)
+
+def rate_limit_reply(client, priority):
+    """None if ``client`` may ask now, otherwise a 429 saying when it may ask again."""
+    if priority != PRIORITY_CLASSES[-1]:
+        return None
+    limited = rate_limiter.acquire(client)
+    if not limited:
+        return None
+    retry_after, limit = limited
+    RATE_LIMITED.inc(limit=limit)
+    print(f"🚦 Rate limiting {client} ({limit} per minute), retry in {retry_after}s")
+    return busy_reply("You're asking questions too quickly. Please wait a moment and try again.", retry_after,
+                      reason="rate_limited", status=429, limit=limit)
+
+def rate_limited_response(client, priority):
+    limited = rate_limit_reply(client, priority)
+    return limited and json_response(limited)
+
+def deadline_from(requested=''):
+    """Absolute deadline: the server default, or sooner if the client asked for ``requested`` seconds."""
+    seconds = REQUEST_DEADLINE_SECONDS or None
+    try:
+        requested = float(requested)
+        seconds = requested if seconds is None else min(seconds, requested)
+    except ValueError:
+        pass
+    return None if seconds is None else time.time() + max(0.0, seconds)
+
+def request_deadline():
+    """Absolute deadline for this request: the server default, or sooner if the client asks."""
+    return deadline_from(request.headers.get(DEADLINE_HEADER, ''))
+
+def client_disconnected():
+    """True once the client has hung up, detected by peeking at the request socket.
+
+    Only streaming responses notice a closed connection on their own (the
+    next write fails), so buffered endpoints poll this while they wait.
+    """
+    sock = request.environ.get('werkzeug.socket')
+    if sock is None or not hasattr(socket, 'MSG_DONTWAIT'):
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+
+def request_token(headers):
+    """The priority token a request presents, if any."""
+    return headers.get(PRIORITY_HEADER) or headers.get('Authorization', '').removeprefix('Bearer ').strip()
+
+def request_client(token=None):
+    """(client, priority class) for this request; clients are told apart by address."""
+    return classify_client(request.remote_addr, token or request_token(request.headers))
+
+def classify_client(address, token=None):
+    """(client, priority class) for a caller at ``address`` presenting ``token``."""
+    client = address or "unknown"
+    if token:
+        for priority, secret in PRIORITY_TOKENS:
+            if hmac.compare_digest(token.encode(), secret.encode()):
+                return client, priority
+    try:
+        address = ipaddress.ip_address(client)
+    except ValueError:
+        return client, DEFAULT_PRIORITY
+    matches = [priority for priority, network in PRIORITY_NETWORKS if address in network]
+    return client, min(matches, key=PRIORITY_CLASSES.index, default=DEFAULT_PRIORITY)
+
+def follow_until_done(flight, deadline):
+    """Wait for ``flight``; returns "done", "deadline" or "client_gone", whichever comes first."""
+    while not flight.wait(CANCEL_POLL_SECONDS):
+        if client_disconnected():
+            return "client_gone"
+        if deadline is not None and time.time() >= deadline:
+            return "deadline"
+    return "done"
+
+async def follow_until_done_async(flight, deadline, is_disconnected):
+    """follow_until_done() for coroutines; ``is_disconnected`` is the ASGI request's check."""
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Event()
+    flight.add_done_callback(lambda flight: wake_soon(loop, finished))
+    while True:
+        try:
+            await asyncio.wait_for(finished.wait(), CANCEL_POLL_SECONDS)
+            return "done"
+        except asyncio.TimeoutError:
+            pass
+        if await is_disconnected():
+            return "client_gone"
+        if deadline is not None and time.time() >= deadline:
+            return "deadline"
+
+def answer_reply(flight, leader, session, user_message, priority, outcome, queue_position):
+    """The /ask reply once following ``flight`` ended with ``outcome`` ("done" or "deadline")."""
+    if outcome == "deadline" and not flight.done:
+        # Others still want this answer; hand back what this request's time allowed
+        if not flight.ticket.granted.is_set():
+            return busy_reply("The request deadline passed while waiting for the AI model. Please try again.", 5, reason="deadline")
+        tokens = len(flight.tokens)
+        response = flight.response
+        response_time = time.time() - flight.ticket.started_at
+        timed_out = True
+    else:
+        if flight.busy:
+            return busy_reply(flight.error, 5, reason=flight.busy)
+        if flight.error:
+            raise RuntimeError(flight.error)
+        tokens = flight.stats["tokens"]
+        response = flight.response
+        response_time = flight.stats["duration"]
+        timed_out = flight.stats["timed_out"]
+    record_follower_turn(session, flight.session, user_message, response)
+
+    if not response:
+        response = "I couldn't generate a reply fast enough. Please try asking again."
+
+    if timed_out:
+        response += "\n\n[Response truncated to keep things responsive. Try asking again for more detail.]"
+    elif flight.stats.get("budget_limited"):
+        response += f"\n\n{BUSY_SHORTENED_NOTICE}"
+
+    print(f"🤖 Answer ({response_time:.1f}s, waited {flight.ticket.wait_time:.1f}s){' [truncated]' if timed_out else ''}: {response[:100]}...")
+
+    return 200, {
+        "success": True,
+        "response": response,
+        "tokens": tokens,
+        "response_time": f"{response_time:.1f}s",
+        "queue_wait": f"{flight.ticket.wait_time:.1f}s",
+        "queue_position": queue_position,
+        "priority": priority,
+        "timed_out": timed_out,
+        "cached": False,
+        "coalesced": not leader,
+        "session_turns": len(session.turns) if session else 0,
+        "reused_context": flight.reused_context,
+        "prompt_eval_saved": f"{flight.stats.get('prefix_saved', 0.0):.2f}s",
+        "degradation": flight.degradation
+    }, {}
+
 @app.route('/ask', methods=['POST'])
 def ask_ai():
     """Chat endpoint exactly like server.py"""
@@ -954,53 +3908,423 @@ def ask_ai():
         if not user_message:
             return jsonify({"success": False, "error": "Empty message"})
         
-        if not model_loaded or not model:
-            return jsonify({
-                "success": False,
-                "error": "AI model is not loaded. Please check the model file."
-            })
+        client, priority = request_client()
+        limited = rate_limited_response(client, priority)
+        if limited:
+            return limited
+        
+        session = session_store.get(data.get('session_id'))
+        cache_key = request_key(user_message, session)
+        vector = None
+        if is_cacheable(cache_key) and not wants_fresh_answer(data):
+            start_time = time.time()
+            cached, vector = lookup_cached_answer(user_message, cache_key)
+            if cached:
+                print(f"⚡ Cache hit: {user_message}")
+                record_follower_turn(session, None, user_message, cached["response"])
+                return jsonify(dict(cached, response_time=f"{time.time() - start_time:.3f}s", cached=True,
+                                    session_turns=len(session.turns) if session else 0))
+        
+        unavailable = model_unavailable_response()
+        if unavailable:
+            return unavailable
         
         print(f"📱 Question: {user_message}")
         
-        # Simple prompt formatting for better responses
-        prompt = f"User: {user_message}\nAssistant:"
-        with model_lock:
-            response, response_time, timed_out, model_error = run_model_inference(prompt)
-
-        if model_error:
-            raise RuntimeError(model_error)
+        deadline = request_deadline()
+        try:
+            flight, leader = single_flight.join(cache_key, user_message, vector, session, deadline=deadline,
+                                                client=client, priority=priority)
+        except QueueFullError as e:
+            print(f"🚦 Queue full, rejecting question (retry in {e.retry_after}s)")
+            return busy_response(str(e), e.retry_after)
 
-        # Clean up response
-        response = response.strip()
-        if response.startswith('Assistant:'):
-            response = response[10:].strip()
+        if not leader:
+            print("🔗 Joined an identical question already being answered")
+        queue_position = inference_queue.position(flight.ticket)
+        outcome = "error"
+        try:
+            outcome = follow_until_done(flight, deadline)
+        finally:
+            single_flight.leave(flight, outcome)
 
-        if not response:
-            response = "I couldn't generate a reply fast enough. Please try asking again."
+        if outcome == "client_gone":
+            print("🛑 Client disconnected before the answer was ready")
+            return Response(status=499)
 
-        if timed_out:
-            response += "\n\n[Response truncated to keep things responsive. Try asking again for more detail.]"
-
-        print(f"🤖 Answer ({response_time:.1f}s){' [truncated]' if timed_out else ''}: {response[:100]}...")
-        
-        return jsonify({
-            "success": True,
-            "response": response,
-            "response_time": f"{response_time:.1f}s",
-            "timed_out": timed_out
-        })
+        return json_response(answer_reply(flight, leader, session, user_message, priority, outcome, queue_position))
         
     except Exception as e:
         print(f"❌ Error: {e}")
+        ERRORS.inc(endpoint="ask")
         return jsonify({
             "success": False,
             "error": str(e)
         })
 
+def cached_events(cached, session):
+    """The events that replay a cached answer on a streaming channel."""
+    return [
+        ("token", {"token": cached["response"]}),
+        ("done", dict(cached, response_time="0.0s", queue_wait="0.0s", truncated=False, notice=None, cached=True,
+                      session_turns=len(session.turns) if session else 0)),
+    ]
+
+def answer_events(flight, leader, session, user_message, priority, deadline, stop_reason=None):
+    """Follow ``flight`` as (event, payload) pairs: queue, token, keepalive, then done, error or cancelled.
+
+    Shared by /ask/stream and the WebSocket channel. ``stop_reason()`` returns
+    a reason once the client no longer wants the answer. The flight is left
+    when the generator finishes; closing it early counts as the client going away.
+    """
+    follower = {"started": False, "first": True}
+    stopped = None
+    # Closing the connection raises GeneratorExit at a yield, leaving this as the outcome
+    outcome = "client_gone"
+    try:
+        for kind, token in flight.events(CANCEL_POLL_SECONDS * 4):
+            stopped = stop_following(flight, deadline, stop_reason)
+            if stopped:
+                break
+            yield from follow_step(flight, follower, kind, token)
+        final, outcome = closing_event(flight, leader, session, user_message, priority, follower, stopped)
+        yield final
+    except Exception as e:
+        outcome = "error"
+        print(f"❌ Stream error: {e}")
+        ERRORS.inc(endpoint="ask_stream")
+        yield "error", {"success": False, "error": str(e)}
+    finally:
+        leave_stream(flight, outcome)
+
+async def answer_events_async(flight, leader, session, user_message, priority, deadline):
+    """answer_events() for the ASGI server, following the flight without holding a thread.
+
+    The server cancels the stream when the client hangs up, which leaves the
+    flight as the client going away.
+    """
+    follower = {"started": False, "first": True}
+    stopped = None
+    outcome = "client_gone"
+    try:
+        async for kind, token in flight.events_async(CANCEL_POLL_SECONDS * 4):
+            stopped = stop_following(flight, deadline)
+            if stopped:
+                break
+            for event in follow_step(flight, follower, kind, token):
+                yield event
+        final, outcome = closing_event(flight, leader, session, user_message, priority, follower, stopped)
+        yield final
+    except Exception as e:
+        outcome = "error"
+        print(f"❌ Stream error: {e}")
+        ERRORS.inc(endpoint="ask_stream")
+        yield "error", {"success": False, "error": str(e)}
+    finally:
+        leave_stream(flight, outcome)
+
+def stop_following(flight, deadline, stop_reason=None):
+    """Why a streaming follower should stop before the flight finishes, or None."""
+    stopped = stop_reason() if stop_reason else None
+    if stopped:
+        return stopped
+    if deadline is not None and time.time() >= deadline and not flight.done:
+        return "deadline"
+    return None
+
+def follow_step(flight, follower, kind, token):
+    """The events one step of ``flight.events()`` turns into for a streaming follower."""
+    events = []
+    # Report the queue position until our turn comes up
+    if not follower["started"]:
+        follower["started"] = flight.ticket.granted.is_set()
+        events.append(("queue", {"position": inference_queue.position(flight.ticket), "waited": round(flight.ticket.wait_time, 1)}))
+    elif kind != "token":
+        events.append(("keepalive", None))
+    if kind == "token" and follower["first"]:
+        # Drop the leading whitespace the model tends to emit first
+        token = token.lstrip()
+        follower["first"] = not token
+    if kind == "token" and token:
+        events.append(("token", {"token": token}))
+    return events
+
+def closing_event(flight, leader, session, user_message, priority, follower, stopped):
+    """The last event for a streaming follower and the outcome it leaves the flight with.
+
+    ``stopped`` is why it stopped following early, None if the flight finished.
+    """
+    if stopped and stopped != "deadline":
+        return ("cancelled", {"success": False, "reason": stopped}), stopped
+    if stopped == "deadline" and not follower["started"]:
+        REJECTIONS.inc(reason="deadline")
+        return ("error", {"success": False, "error": "The request deadline passed while waiting for the AI model. Please try again."}), stopped
+    outcome = stopped or "done"
+    if flight.error:
+        if flight.busy:
+            REJECTIONS.inc(reason=flight.busy)
+        return ("error", {"success": False, "error": flight.error}), outcome
+
+    ticket = flight.ticket
+    stats = flight.stats
+    response = flight.response
+    # A deadline that ran out before the shared generation did still gets the partial answer
+    duration = time.time() - ticket.started_at if outcome == "deadline" else stats["duration"]
+    timed_out = outcome == "deadline" or stats["timed_out"]
+    record_follower_turn(session, flight.session, user_message, response)
+    notice = None
+    if not response:
+        notice = "I couldn't generate a reply fast enough. Please try asking again."
+    elif timed_out:
+        notice = "[Response truncated to keep things responsive. Try asking again for more detail.]"
+    elif stats.get("budget_limited"):
+        notice = BUSY_SHORTENED_NOTICE
+
+    print(f"🤖 Streamed answer ({duration:.1f}s){' [truncated]' if timed_out else ''}: {response[:100]}...")
+    return ("done", {
+        "success": True,
+        "response": response,
+        "response_time": f"{duration:.1f}s",
+        "queue_wait": f"{ticket.wait_time:.1f}s",
+        "priority": priority,
+        "timed_out": timed_out,
+        "truncated": stats.get("truncated", False),
+        "notice": notice,
+        "cached": False,
+        "coalesced": not leader,
+        "session_turns": len(session.turns) if session else 0,
+        "reused_context": flight.reused_context,
+        "prompt_eval_saved": f"{stats.get('prefix_saved', 0.0):.2f}s",
+        "degradation": flight.degradation
+    }), outcome
+
+def leave_stream(flight, outcome):
+    if outcome == "client_gone":
+        print("🛑 Client closed the stream")
+    elif outcome == "cancelled":
+        print("🛑 Client stopped the answer")
+    single_flight.leave(flight, outcome)
+
+@app.route('/ask/stream', methods=['POST'])
+def ask_ai_stream():
+    """Streaming chat endpoint: pushes tokens as Server-Sent Events while they are generated"""
+    data = request.get_json(silent=True) or {}
+    user_message = data.get('message', '').strip()
+
+    if not user_message:
+        return jsonify({"success": False, "error": "Empty message"})
+
+    client, priority = request_client()
+    limited = rate_limited_response(client, priority)
+    if limited:
+        return limited
+
+    session = session_store.get(data.get('session_id'))
+    cache_key = request_key(user_message, session)
+    cached, vector = None, None
+    if is_cacheable(cache_key) and not wants_fresh_answer(data):
+        cached, vector = lookup_cached_answer(user_message, cache_key)
+    if cached:
+        print(f"⚡ Cache hit (stream): {user_message}")
+        record_follower_turn(session, None, user_message, cached["response"])
+        frames = [sse_event(event, payload) for event, payload in cached_events(cached, session)]
+        return Response(frames, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    unavailable = model_unavailable_response()
+    if unavailable:
+        return unavailable
+
+    print(f"📱 Question (stream): {user_message}")
+
+    deadline = request_deadline()
+    try:
+        flight, leader = single_flight.join(cache_key, user_message, vector, session, deadline=deadline,
+                                            client=client, priority=priority)
+    except QueueFullError as e:
+        print(f"🚦 Queue full, rejecting question (retry in {e.retry_after}s)")
+        return busy_response(str(e), e.retry_after)
+
+    if not leader:
+        print("🔗 Joined an identical question already being answered")
+
+    def event_stream():
+        events = answer_events(flight, leader, session, user_message, priority, deadline)
+        try:
+            for event, payload in events:
+                # Comment frame: keeps proxies from timing out and reveals a closed connection
+                yield ": keepalive\n\n" if event == "keepalive" else sse_event(event, payload)
+        finally:
+            events.close()
+
+    return Response(
+        stream_with_context(event_stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# WebSocket chat: the socket's handshake identifies the client once, and each question
+# carries a page-chosen id that every event about it echoes back
+socket_lock = Lock()
+socket_clients = {}
+# (sid, question id) -> None while the page wants the answer, else why it stopped
+socket_questions = {}
+
+def socket_connect(auth=None):
+    """Class the client from its handshake, taking the priority token from the connect payload."""
+    token = auth.get('token') if isinstance(auth, dict) else None
+    with socket_lock:
+        socket_clients[request.sid] = request_client(token or None)
+
+def socket_disconnect(reason=None):
+    """Stop every answer the closed socket was still following."""
+    with socket_lock:
+        socket_clients.pop(request.sid, None)
+        for key in socket_questions:
+            if key[0] == request.sid:
+                socket_questions[key] = "client_gone"
+
+def socket_cancel(data):
+    """The page's stop button: end the answer and acknowledge with a cancelled event."""
+    key = (request.sid, str((data or {}).get('id', '')))
+    with socket_lock:
+        if key in socket_questions and socket_questions[key] is None:
+            socket_questions[key] = "cancelled"
+
+def socket_ask(data):
+    """One question over the socket, answered with the same events as /ask/stream."""
+    data = data if isinstance(data, dict) else {}
+    sid = request.sid
+    key = (sid, str(data.get('id', ''))[:64])
+
+    def send(event, payload):
+        socketio.emit(event, dict(payload, id=key[1]), to=sid)
+
+    user_message = str(data.get('message', '')).strip()
+    if not user_message:
+        return send("error", {"success": False, "error": "Empty message"})
+
+    client, priority = socket_clients.get(sid) or request_client()
+    refusal = rate_limit_reply(client, priority)
+    if refusal:
+        return send("error", refusal[1])
+
+    session = session_store.get(data.get('session_id'))
+    cache_key = request_key(user_message, session)
+    cached, vector = None, None
+    if is_cacheable(cache_key) and not wants_fresh_answer(data):
+        cached, vector = lookup_cached_answer(user_message, cache_key)
+    if cached:
+        print(f"⚡ Cache hit (socket): {user_message}")
+        record_follower_turn(session, None, user_message, cached["response"])
+        for event, payload in cached_events(cached, session):
+            send(event, payload)
+        return
+
+    refusal = model_unavailable_reply()
+    if refusal:
+        return send("error", refusal[1])
+
+    print(f"📱 Question (socket): {user_message}")
+
+    deadline = request_deadline()
+    try:
+        flight, leader = single_flight.join(cache_key, user_message, vector, session, deadline=deadline,
+                                            client=client, priority=priority)
+    except QueueFullError as e:
+        print(f"🚦 Queue full, rejecting question (retry in {e.retry_after}s)")
+        return send("error", busy_reply(str(e), e.retry_after)[1])
+
+    if not leader:
+        print("🔗 Joined an identical question already being answered")
+    with socket_lock:
+        socket_questions[key] = None
+    try:
+        for event, payload in answer_events(flight, leader, session, user_message, priority, deadline,
+                                            lambda: socket_questions.get(key)):
+            if event != "keepalive":
+                send(event, payload)
+    finally:
+        with socket_lock:
+            socket_questions.pop(key, None)
+
+if socketio is not None:
+    socketio.on_event('connect', socket_connect)
+    socketio.on_event('disconnect', socket_disconnect)
+    socketio.on_event('cancel', socket_cancel)
+    socketio.on_event('ask', socket_ask)
+
+@app.route('/ask/batch', methods=['POST'])
+def ask_ai_batch():
+    """Bulk endpoint: answers a list of questions and streams each result as an NDJSON line"""
+    data = request.get_json(silent=True) or {}
+    questions = data.get('questions')
+
+    if not isinstance(questions, list) or not questions:
+        return jsonify({"success": False, "error": "Expected a non-empty 'questions' list"}), 400
+
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        return jsonify({"success": False, "error": f"At most {MAX_BATCH_QUESTIONS} questions per batch"}), 400
+
+    unavailable = model_unavailable_response()
+    if unavailable:
+        return unavailable
+
+    print(f"📚 Batch of {len(questions)} questions")
+    fresh = wants_fresh_answer(data)
+
+    def ndjson_stream():
+        for result in run_batch(questions, fresh):
+            if result.get("done"):
+                print(f"📚 Batch finished: {result['answered']}/{result['questions']} answered, {result['tokens_per_second']} tokens/s")
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(ndjson_stream()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/manifest.json')
 def manifest():
     """Serve PWA manifest"""
-    return send_from_directory('static', 'manifest.json') if os.path.exists('static/manifest.json') else jsonify({})
+    if not os.path.exists('static/manifest.json'):
+        return jsonify({})
+    response = send_from_directory('static', 'manifest.json', mimetype='application/manifest+json')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/sw.js')
+def service_worker():
+    """Service worker, served from the root so it controls every page"""
+    response = send_from_directory('static', 'sw.js', mimetype='application/javascript')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.after_request
+def cache_vendor_assets(response):
+    """Vendored files are versioned by path, so browsers may keep them for a year"""
+    if request.path.startswith(VENDOR_PREFIX) and response.status_code == 200:
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/health/live')
+def liveness():
+    """Liveness probe: the web server is up, whatever the model is doing"""
+    return jsonify({"status": "alive", "uptime_seconds": round(time.time() - model_loader.started_at, 1)})
+
+@app.route('/health/ready')
+def readiness():
+    """Readiness probe: 200 once the model pool is loaded and warmed, 503 until then"""
+    status = model_loader.status()
+    if model_loader.ready:
+        return jsonify(status)
+    response = jsonify(status)
+    response.status_code = 503
+    if model_loader.state != "failed":
+        response.headers['Retry-After'] = str(WARMUP_RETRY_SECONDS)
+    return response
 
 @app.route('/health')
 def health_check():
@@ -1009,22 +4333,331 @@ def health_check():
         "status": "healthy",
         "server": "Zia Edge Enterprise",
         "mode": "offline",
-        "ai_model": "loaded" if model_loaded else "not_loaded",
+        "ai_model": "loaded" if model_loader.ready else model_loader.state,
+        "readiness": model_loader.status(),
+        "degradation": load_governor.status(),
+        "autotune": {
+            "mode": AUTOTUNE_MODE,
+            "source": tuning["source"],
+            "threads": CPU_THREADS,
+            "n_batch": GENERATION_CONFIG["n_batch"],
+            "candidates": tuning["profile"]["candidates"] if tuning["profile"] else []
+        },
+        "queue": inference_queue.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "cache": response_cache.stats(),
+        "coalesced_requests": single_flight.coalesced,
+        "sessions": session_store.stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache else None,
+        "instances": [
+            {
+                "index": i.index,
+                "threads": i.n_threads,
+                "requests_served": i.requests_served,
+                "prefix_tokens": i.prefix_n_past or 0,
+                "prefix_eval_seconds": round(i.prefix_eval_seconds, 3),
+                "warmup_seconds": round(i.warmup_seconds, 3),
+                "pid": i.pid,
+                "restarts": i.restarts,
+                "batch": i.batch.stats() if i.batch else None,
+                "speculative": i.speculative.stats() if i.speculative else None,
+                "memory": process_memory(i.pid, model_file_path())
+            }
+            for i in model_instances
+        ],
+        "server_mode": SERVER_MODE,
+        "memory": {
+            "server": process_memory(os.getpid()),
+            "server_threads": active_count(),
+            "model_file": model_file_path(),
+            "prefetched": model_loader.weights is not None,
+            "worker_processes": WORKER_PROCESSES
+        },
         "timestamp": datetime.datetime.now().isoformat()
     })
 
+def build_asgi_app():
+    """The SERVER_MODE=asgi application: async /ask and /ask/stream in front of the Flask app.
+
+    A request waiting in the queue or following a generation is a coroutine
+    the flight wakes on each token, so hundreds of idle connections cost no
+    more than their sockets. Everything else (pages, health, batch) is the
+    Flask app mounted underneath.
+    """
+    from fastapi import FastAPI, Request
+    from fastapi.middleware.wsgi import WSGIMiddleware
+    from fastapi.responses import JSONResponse, Response as RawResponse, StreamingResponse
+
+    api = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+    executor = ThreadPoolExecutor(ASGI_EXECUTOR_THREADS, thread_name_prefix="asgi")
+
+    def reply(result):
+        status, payload, headers = result
+        return JSONResponse(payload, status, headers)
+
+    async def read_question(req):
+        """(data, user_message, client, priority) for a chat request."""
+        try:
+            data = await req.json()
+        except ValueError:
+            data = None
+        data = data if isinstance(data, dict) else {}
+        client, priority = classify_client(req.client.host if req.client else None, request_token(req.headers))
+        return data, str(data.get('message', '')).strip(), client, priority
+
+    async def find_cached(req, data, user_message, cache_key):
+        """lookup_cached_answer() off the event loop, since embedding the question blocks."""
+        if not is_cacheable(cache_key) or wants_fresh_answer(data, req.headers):
+            return None, None
+        return await asyncio.get_running_loop().run_in_executor(executor, lookup_cached_answer, user_message, cache_key)
+
+    @api.post('/ask')
+    async def ask(req: Request):
+        try:
+            data, user_message, client, priority = await read_question(req)
+            if not user_message:
+                return JSONResponse({"success": False, "error": "Empty message"})
+            limited = rate_limit_reply(client, priority)
+            if limited:
+                return reply(limited)
+
+            session = session_store.get(data.get('session_id'))
+            cache_key = request_key(user_message, session)
+            start_time = time.time()
+            cached, vector = await find_cached(req, data, user_message, cache_key)
+            if cached:
+                print(f"⚡ Cache hit: {user_message}")
+                record_follower_turn(session, None, user_message, cached["response"])
+                return JSONResponse(dict(cached, response_time=f"{time.time() - start_time:.3f}s", cached=True,
+                                         session_turns=len(session.turns) if session else 0))
+
+            unavailable = model_unavailable_reply()
+            if unavailable:
+                return reply(unavailable)
+
+            print(f"📱 Question: {user_message}")
+
+            deadline = deadline_from(req.headers.get(DEADLINE_HEADER, ''))
+            try:
+                flight, leader = single_flight.join(cache_key, user_message, vector, session, deadline=deadline,
+                                                    client=client, priority=priority)
+            except QueueFullError as e:
+                print(f"🚦 Queue full, rejecting question (retry in {e.retry_after}s)")
+                return reply(busy_reply(str(e), e.retry_after))
+
+            if not leader:
+                print("🔗 Joined an identical question already being answered")
+            queue_position = inference_queue.position(flight.ticket)
+            outcome = "error"
+            try:
+                outcome = await follow_until_done_async(flight, deadline, req.is_disconnected)
+            finally:
+                single_flight.leave(flight, outcome)
+
+            if outcome == "client_gone":
+                print("🛑 Client disconnected before the answer was ready")
+                return RawResponse(status_code=499)
+            return reply(answer_reply(flight, leader, session, user_message, priority, outcome, queue_position))
+        except Exception as e:
+            print(f"❌ Error: {e}")
+            ERRORS.inc(endpoint="ask")
+            return JSONResponse({"success": False, "error": str(e)})
+
+    @api.post('/ask/stream')
+    async def ask_stream(req: Request):
+        data, user_message, client, priority = await read_question(req)
+        if not user_message:
+            return JSONResponse({"success": False, "error": "Empty message"})
+        limited = rate_limit_reply(client, priority)
+        if limited:
+            return reply(limited)
+
+        session = session_store.get(data.get('session_id'))
+        cache_key = request_key(user_message, session)
+        cached, vector = await find_cached(req, data, user_message, cache_key)
+        if cached:
+            print(f"⚡ Cache hit (stream): {user_message}")
+            record_follower_turn(session, None, user_message, cached["response"])
+            frames = ''.join(sse_event(event, payload) for event, payload in cached_events(cached, session))
+            return RawResponse(frames, media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+        unavailable = model_unavailable_reply()
+        if unavailable:
+            return reply(unavailable)
+
+        print(f"📱 Question (stream): {user_message}")
+
+        deadline = deadline_from(req.headers.get(DEADLINE_HEADER, ''))
+        try:
+            flight, leader = single_flight.join(cache_key, user_message, vector, session, deadline=deadline,
+                                                client=client, priority=priority)
+        except QueueFullError as e:
+            print(f"🚦 Queue full, rejecting question (retry in {e.retry_after}s)")
+            return reply(busy_reply(str(e), e.retry_after))
+
+        if not leader:
+            print("🔗 Joined an identical question already being answered")
+
+        async def event_stream():
+            events = answer_events_async(flight, leader, session, user_message, priority, deadline)
+            try:
+                async for event, payload in events:
+                    yield ": keepalive\n\n" if event == "keepalive" else sse_event(event, payload)
+            finally:
+                await events.aclose()
+
+        return StreamingResponse(event_stream(), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    api.mount('/', WSGIMiddleware(app))
+    return api
+
+def read_questions(path):
+    """Questions from a JSON list or a text file with one question per line ("-" reads stdin)."""
+    handle = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    with handle:
+        text = handle.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def run_batch_cli(args):
+    """Offline worksheet mode: answer a file of questions without starting the web server."""
+    print("⏳ Waiting for the model to load...", file=sys.stderr)
+    model_loader.wait()
+    if not model_loader.serving:
+        print("❌ AI model is not loaded. Please check the model file.")
+        return 1
+
+    questions = read_questions(args.batch)
+    print(f"📚 Answering {len(questions)} questions...")
+    output = open(args.output, 'w', encoding='utf-8') if args.output else BATCH_RESULTS
+    try:
+        for result in run_batch(questions, args.fresh):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            if result.get("done"):
+                print(f"✅ {result['answered']}/{result['questions']} answered in {result['elapsed']} ({result['tokens_per_second']} tokens/s)", file=sys.stderr)
+    finally:
+        if output is not BATCH_RESULTS:
+            output.close()
+    return 0
+
+def run_autotune_cli():
+    """Calibrate threads and n_batch on this machine, save the profile and exit."""
+    if WORKER_PROCESSES:
+        print("❌ Autotuning runs the model in-process. Please run it without WORKER_PROCESSES=1.")
+        return 1
+    print("⏳ Waiting for the model to load...")
+    model_loader.wait()
+    if not model_loader.serving:
+        print("❌ AI model is not loaded. Please check the model file.")
+        return 1
+    if not model_instances[0].supports_context_reuse:
+        print("❌ This model backend cannot be autotuned.")
+        return 1
+    if tuning["source"] != "calibrated":
+        calibrate(model_instances[0])
+    print(f"✅ Later startups will use {CPU_THREADS} threads and n_batch {GENERATION_CONFIG['n_batch']} (MODEL_AUTOTUNE=off to ignore)")
+    return 0
+
+def run_worker():
+    """Inference worker process: serve one model instance to the web tier over stdin/stdout.
+
+    The main thread runs requests one at a time; a reader thread answers
+    pings and marks cancellations so both get through mid-generation.
+    """
+    send_lock = Lock()
+
+    def send(message):
+        with send_lock:
+            WORKER_PIPE.write(json.dumps(message) + "\n")
+            WORKER_PIPE.flush()
+
+    n_threads = int(os.environ.get("ZIA_WORKER_THREADS") or CPU_THREADS)
+    try:
+        instance = ModelInstance(WORKER_INDEX, load_model(n_threads), n_threads)
+    except Exception as e:
+        send({"op": "failed", "error": str(e)})
+        return 1
+    send({"op": "ready", "pid": os.getpid(), "context_reuse": instance.supports_context_reuse})
+
+    requests = Queue()
+    cancelled = set()
+
+    def read_requests():
+        for line in sys.stdin:
+            message = json.loads(line)
+            if message["op"] == "ping":
+                send({"op": "pong"})
+            elif message["op"] == "cancel":
+                cancelled.add(message["id"])
+            else:
+                requests.put(message)
+        # The web tier closed the pipe: it has exited
+        requests.put(None)
+
+    Thread(target=read_requests, name="worker-requests", daemon=True).start()
+    while True:
+        message = requests.get()
+        if message is None:
+            return 0
+        call_id = message["id"]
+        try:
+            result = {}
+            if message["op"] == "generate":
+                keep_going = lambda token_id, response: call_id not in cancelled
+                for token in instance.generate(message["prompt"], message["reset_context"], keep_going, **message["config"]):
+                    send({"id": call_id, "token": token})
+            elif message["op"] == "snapshot":
+                instance.snapshot_prefix(message["prefix"])
+                result = {"prefix_n_past": instance.prefix_n_past, "prefix_eval_seconds": instance.prefix_eval_seconds}
+            elif message["op"] == "warm_up":
+                instance.warm_up(message["prompt"], message["max_tokens"])
+                result = {"warmup_seconds": instance.warmup_seconds}
+            elif message["op"] == "set_threads":
+                instance.set_threads(message["n_threads"])
+            send(dict(result, id=call_id, done=True))
+        except Exception as e:
+            send({"id": call_id, "error": str(e)})
+        finally:
+            cancelled.discard(call_id)
+
+
 if __name__ == '__main__':
+    if WORKER_INDEX is not None:
+        sys.exit(run_worker())
+
+    parser = argparse.ArgumentParser(description="Zia Edge offline AI server")
+    parser.add_argument('--batch', metavar='FILE', help="answer questions from FILE (JSON list or one per line, '-' for stdin) and exit")
+    parser.add_argument('--output', metavar='FILE', help="write batch results as NDJSON to FILE instead of stdout")
+    parser.add_argument('--fresh', action='store_true', help="ignore cached answers in batch mode")
+    parser.add_argument('--autotune', action='store_true', help="calibrate CPU threads and n_batch for this machine, save the result and exit")
+    args = parser.parse_args()
+
+    if args.autotune:
+        sys.exit(run_autotune_cli())
+    if args.batch:
+        sys.exit(run_batch_cli(args))
+
     print(f"\n🎯 SERVER READY!")
     print(f"📍 ACCESS URL: {SERVER_URL}")
     print(f"📱 QR Code Generated - Scan with phone camera!")
     print(f"💬 Chat URL: {SERVER_URL}/zia-chat")
-    print(f"🤖 Model: Orca 2 7B")
+    print(f"🤖 Model: Orca 2 7B x{MODEL_INSTANCES}")
     print(f"💼 Zoho UI Framework: ACTIVATED")
-    print(f"🤖 AI Model Status: {'LOADED ✅' if model_loaded else 'NOT LOADED ❌'}")
+    print(f"🤖 AI Model Status: {'LOADED ✅' if model_loader.ready else 'LOADING IN BACKGROUND ⏳ (see /health/ready)'}")
     print(f"⚡ Server starting...\n")
     
     try:
-        app.run(host='0.0.0.0', port=SERVER_PORT, debug=False, threaded=True)
+        if SERVER_MODE == "asgi":
+            import uvicorn
+            uvicorn.run(build_asgi_app(), host='0.0.0.0', port=SERVER_PORT, log_level="warning")
+        elif socketio is not None:
+            socketio.run(app, host='0.0.0.0', port=SERVER_PORT, debug=False, allow_unsafe_werkzeug=True)
+        else:
+            app.run(host='0.0.0.0', port=SERVER_PORT, debug=False, threaded=True)
     except Exception as e:
         print(f"❌ Server startup error: {e}")
         print("⚠️  Please check if port 8080 is available")
\ No newline at end of file